@@ -0,0 +1,21 @@
+#! /usr/bin/env python3
+#
+# Decode reassembled AIS payloads
+#
+# This lives in its own module so the function can be run in a pool of worker processes
+#
+import ais # This is part of python3-ais package in Ubuntu
+
+def decodeBatch(items:list[tuple]) -> list:
+    """ Decode a list of (payload, fillbits, t) tuples,
+        returning the decoded dictionary or an error message for each one
+    """
+    results = []
+    for (payload, fillbits, t) in items:
+        try:
+            info = ais.decode(str(payload, "UTF-8"), fillbits)
+            info["t"] = t
+            results.append(info)
+        except Exception as e:
+            results.append(f"Error decoding {bytes(payload)}, {fillbits}, {e}")
+    return results
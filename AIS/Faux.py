@@ -0,0 +1,115 @@
+#! /usr/bin/env python3
+#
+# Faux AIS sources which send the sentences in a sample database
+# to ourselves via UDP or a pseudo serial device
+#
+from argparse import ArgumentParser
+from TPWUtils import Thread
+from Metrics import Sampler
+from abc import ABC, abstractmethod
+import sqlite3
+import socket
+import pty
+import logging
+import time
+import os
+
+class Faux(Thread.Thread, ABC):
+    """ Send the sentences in the sample database, in their original order, forever
+
+    By default one sentence is sent every --fauxTime seconds.
+    With --fauxSpeed the original inter-arrival times are replayed scaled by the speed,
+    and with --fauxMaxRate sentences are sent as fast as possible,
+    which lets the whole pipeline be driven at many times real traffic rates.
+    """
+    def __init__(self, name:str, args:ArgumentParser) -> None:
+        Thread.Thread.__init__(self, name, args)
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Faux options")
+        grp.add_argument("--fauxTime", type=float, default=1, help="Time between AIS prints")
+        grp.add_argument("--fauxDB", type=str, default="sample.raw.db",
+                help="Faux SQLite3 database")
+        grp.add_argument("--fauxReport", type=float, default=60,
+                help="Seconds between achieved send rate reports")
+        exc = grp.add_mutually_exclusive_group()
+        exc.add_argument("--fauxSpeed", type=float,
+                help="Replay the original inter-arrival times sped up by this factor")
+        exc.add_argument("--fauxMaxRate", action="store_true",
+                help="Replay the sentences as fast as possible")
+
+    def sentences(self):
+        # Stream (t, msg) from the database with a cursor, restarting at the end,
+        # with times shifted so they keep increasing across passes
+        offset = 0 # Added to the stored times, None until the first sentence of a pass
+        tLast = None # Shifted time of the last sentence in the previous pass
+        while True:
+            t = None
+            with sqlite3.connect(self.args.fauxDB) as db:
+                cur = db.cursor()
+                cur.execute("SELECT t, msg FROM raw ORDER BY t;") # Order for multipart messages
+                for (t, msg) in cur:
+                    if offset is None: offset = tLast - t + 1 # One second between passes
+                    yield (t + offset, msg)
+            if t is None: raise Exception(f"No sentences in {self.args.fauxDB}")
+            tLast = t + offset
+            offset = None
+
+    @abstractmethod
+    def send(self, msg:bytes) -> None:
+        """ Send one sentence to the reader """
+
+    def runIt(self) -> None: # Called on thread start
+        args = self.args
+        dt = args.fauxTime
+        speed = args.fauxSpeed
+        maxRate = args.fauxMaxRate
+        if speed is not None and speed <= 0: raise ValueError(f"--fauxSpeed must be positive, {speed}")
+        logging.info("Starting dt=%s speed=%s maxRate=%s", dt, speed, maxRate)
+
+        sample = Sampler(args.logSample)
+        tReport = time.time() + args.fauxReport
+        nSent = 0
+        nReport = 0
+        t0 = None
+        for (t, msg) in self.sentences():
+            now = time.time()
+            if maxRate:
+                pass
+            elif speed is None:
+                time.sleep(dt)
+            else: # Wait until this sentence is due
+                if t0 is None: (t0, w0) = (t, now)
+                delay = w0 + (t - t0) / speed - now
+                if delay > 0: time.sleep(delay)
+            if sample(): logging.info("Sending %s", msg)
+            self.send(msg)
+            nSent += 1
+            if now >= tReport:
+                dtReport = now - tReport + args.fauxReport
+                lag = 0 if speed is None or maxRate else max(0, now - w0 - (t - t0) / speed)
+                logging.info("Sent %s sentences in %.1f seconds, %.1f/second, lag %.3f seconds",
+                        nSent - nReport, dtReport, (nSent - nReport) / dtReport, lag)
+                (tReport, nReport) = (now + args.fauxReport, nSent)
+
+class FauxUDP(Faux):
+    def __init__(self, args:ArgumentParser) -> None:
+        Faux.__init__(self, "FauxUDP", args)
+        args.udp = (args.udp or []) + [args.fauxUDP]
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__target = ("127.0.0.1", args.fauxUDP)
+
+    def send(self, msg:bytes) -> None:
+        self.__socket.sendto(msg, self.__target)
+
+class FauxSerial(Faux):
+    def __init__(self, args:ArgumentParser) -> None:
+        Faux.__init__(self, "FauxSerial", args)
+        (self.__master, slave) = pty.openpty() # Create a pseudoTTY device pair
+        device = os.ttyname(slave)
+        args.serial = (args.serial or []) + [device]
+        logging.info("Serial device name %s", device)
+
+    def send(self, msg:bytes) -> None:
+        os.write(self.__master, msg + b"\r\n") # The sample sentences are stored unterminated
@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+#
+# Split a serial byte stream into \r\n terminated NEMA sentences
+#
+# Bytes are read straight into a preallocated buffer through a memoryview,
+# only the newly received bytes are scanned for line endings,
+# and the only data ever moved is a trailing partial sentence when the buffer wraps
+#
+import logging
+import os
+
+class LineFramer:
+    def __init__(self, size:int=65536) -> None:
+        self.__buffer = bytearray(size)
+        self.__view = memoryview(self.__buffer)
+        self.__size = size
+        self.__start = 0 # Start of the current partial sentence
+        self.__scan = 0 # Bytes before this have already been scanned for \n
+        self.__end = 0 # End of the received bytes
+        self.nLines = 0
+        self.nBytes = 0
+        self.nDiscarded = 0 # Lines which were not \r terminated or were too long
+
+    def __repr__(self) -> str:
+        return f"lines={self.nLines} bytes={self.nBytes} discarded={self.nDiscarded}"
+
+    def __room(self) -> int:
+        # Offset of the free space at the end of the buffer,
+        # wrapping the partial sentence to the front if the buffer is full
+        start = self.__start
+        end = self.__end
+        if start == end: # Nothing pending, so start over at the front
+            self.__start = self.__scan = self.__end = 0
+            return 0
+        if end < self.__size: return end
+        if start == 0: # A full buffer without a \n is not a NEMA sentence
+            logging.warning("Discarding %s bytes without a line ending", end)
+            self.nDiscarded += 1
+            self.__start = self.__scan = self.__end = 0
+            return 0
+        n = end - start
+        self.__buffer[:n] = self.__view[start:end]
+        self.__scan -= start
+        self.__start = 0
+        self.__end = n
+        return n
+
+    def readFrom(self, fd:int) -> int:
+        """ Read whatever is available on fd, returning the number of bytes, 0 at EOF """
+        n = os.readv(fd, (self.__view[self.__room():],))
+        self.__end += n
+        self.nBytes += n
+        return n
+
+    def lines(self) -> list[bytes]:
+        """ Return the complete sentences received so far, with their \\r but not \\n """
+        end = self.__end
+        last = self.__buffer.rfind(b"\n", self.__scan, end) # Only look at the new bytes
+        self.__scan = end
+        if last < 0: return [] # Still a partial sentence
+        start = self.__start
+        self.__start = last + 1
+        # One copy of the complete sentences, then let split do the work in C
+        complete = bytes(self.__view[start:last]).split(b"\n")
+        n = len(complete)
+        if n == 1 and complete[0][-1:] == b"\r" and len(complete[0]) > 1: # The common case
+            lines = complete
+        else:
+            lines = [line for line in complete if line[-1:] == b"\r" and len(line) > 1]
+        self.nDiscarded += n - len(lines)
+        self.nLines += len(lines)
+        return lines
+
+if __name__ == "__main__":
+    # Benchmark the framer against the original split the whole buffer approach
+    # using chunks read from a FauxSerial pseudo serial device
+    from argparse import ArgumentParser
+    from Faux import Faux, FauxSerial
+    import serial
+    import select
+    import time
+
+    parser = ArgumentParser()
+    Faux.addArgs(parser)
+    parser.add_argument("--capture", type=float, default=5,
+            help="Seconds to read chunks from the FauxSerial device")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of passes through the chunks")
+    parser.add_argument("--coalesce", type=int, default=1,
+            help="Join this many captured chunks, to mimic reads which fall behind")
+    args = parser.parse_args()
+    args.serial = None
+    args.logSample = 0
+
+    faux = FauxSerial(args)
+    faux.start()
+    chunks = []
+    with serial.Serial(port=args.serial[0], timeout=0) as s: # Puts the pty in raw mode
+        tEnd = time.time() + args.capture
+        while time.time() < tEnd:
+            (rlist, wlist, xlist) = select.select([s], [], [], 1)
+            if rlist: chunks.append(s.read(65536))
+    chunks = [b"".join(chunks[i:i + args.coalesce]) for i in range(0, len(chunks), args.coalesce)]
+    nBytes = sum(map(len, chunks))
+    print(f"Captured {len(chunks)} chunks {nBytes} bytes")
+
+    (rfd, wfd) = os.pipe() # Both paths read the chunks from a file descriptor, as ReadSerial does
+
+    def original(chunks:list) -> int:
+        n = 0
+        buffer = bytearray()
+        for chunk in chunks:
+            os.write(wfd, chunk)
+            buffer += os.read(rfd, 65536)
+            lines = buffer.split(b"\n")
+            for line in lines:
+                if line == b"": continue
+                if (len(line) > 1) and line[-1:] == b"\r": n += 1
+            if len(lines):
+                if lines[-1] == b"" or lines[-1][-1] == "\r":
+                    buffer = bytearray()
+                else:
+                    buffer = buffer[-len(lines[-1]):]
+        return n
+
+    def framed(chunks:list) -> int:
+        n = 0
+        framer = LineFramer()
+        for chunk in chunks:
+            os.write(wfd, chunk)
+            framer.readFrom(rfd)
+            n += len(framer.lines())
+        return n
+
+    for (name, func) in (("Original", original), ("Framer", framed)):
+        stime = time.time()
+        for cnt in range(args.repeat): n = func(chunks)
+        dt = time.time() - stime
+        print(f"{name:9s} {n} lines {dt:.3f} seconds",
+                f"{n * args.repeat / dt:.0f} lines/second {nBytes * args.repeat / dt / 1e6:.1f} MB/s")
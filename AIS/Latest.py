@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+#
+# Keep the latest state of every vessel in memory, keyed by MMSI,
+# and periodically write a compact JSON snapshot of it for the web map
+#
+# The snapshot is written to a temporary file in the same directory then renamed,
+# so readers never see a partial file.
+#
+from argparse import ArgumentParser
+from TPWUtils import Thread
+from Queues import BoundedQueue
+import tempfile
+import logging
+import queue
+import json
+import time
+import os
+
+class Latest(Thread.Thread):
+    __position = (1, 2, 3, 18, 19, 27) # Message ids with a position report
+    __static = (5, 19, 24) # Message ids with the vessel's name
+    # Decoded field to snapshot key, for fields which are kept when present
+    __positionKeys = {"x": "lon", "y": "lat", "sog": "sog", "cog": "cog", "true_heading": "hdg"}
+    __staticKeys = {"name": "name", "callsign": "callsign", "type_and_cargo": "type"}
+    # Values meaning "not available" in AIS
+    __unavailable = {"x": 181, "y": 91, "sog": 102.3, "cog": 360, "true_heading": 511}
+
+    def __init__(self, args:ArgumentParser, decrypt) -> None:
+        Thread.Thread.__init__(self, "Latest", args)
+        self.queue = BoundedQueue("Latest", args)
+        decrypt.addQueue(self.queue)
+        self.vessels = {} # mmsi -> latest state
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Latest vessel state options")
+        grp.add_argument("--latest", type=str, help="JSON file to snapshot the latest vessel states to")
+        grp.add_argument("--latestInterval", type=float, default=10,
+                help="Seconds between snapshots")
+        grp.add_argument("--latestMaxAge", type=float, default=3600,
+                help="Vessels not heard from for this many seconds are dropped")
+
+    def update(self, msg:dict) -> bool:
+        ident = msg.get("id")
+        if "mmsi" not in msg or "t" not in msg: return False
+        isPosition = ident in self.__position
+        isStatic = ident in self.__static
+        if not (isPosition or isStatic): return False
+        mmsi = msg["mmsi"]
+        t = msg["t"]
+        if mmsi not in self.vessels: self.vessels[mmsi] = {"mmsi": mmsi}
+        info = self.vessels[mmsi]
+        info["t"] = max(t, info.get("t", t))
+        if isPosition and self.__validPosition(msg) and t >= info.get("tPos", t):
+            info["tPos"] = t
+            self.__copy(msg, self.__positionKeys, info)
+        if isStatic:
+            self.__copy(msg, self.__staticKeys, info)
+        return True
+
+    @staticmethod
+    def __validPosition(msg:dict) -> bool:
+        x = msg.get("x")
+        y = msg.get("y")
+        return x is not None and y is not None and abs(x) <= 180 and abs(y) <= 90
+
+    def __copy(self, msg:dict, keys:dict, info:dict) -> None:
+        for (key, name) in keys.items():
+            if key not in msg: continue
+            val = msg[key]
+            if key in self.__unavailable and abs(val - self.__unavailable[key]) < 0.01:
+                continue # Decoded floats are single precision, so no exact comparisons
+            if isinstance(val, str):
+                val = val.strip("@ ") # AIS strings are padded with @
+                if not val: continue
+            info[name] = val
+
+    def expire(self, now:float) -> None:
+        tMin = now - self.args.latestMaxAge
+        for mmsi in [mmsi for (mmsi, info) in self.vessels.items() if info["t"] < tMin]:
+            del self.vessels[mmsi]
+
+    def snapshot(self, now:float) -> None:
+        fn = self.args.latest
+        (dirname, basename) = os.path.split(os.path.abspath(fn))
+        stime = time.time()
+        with tempfile.NamedTemporaryFile(mode="w", dir=dirname, prefix=basename + ".",
+                delete=False) as fp:
+            try:
+                json.dump({"t": now, "vessels": list(self.vessels.values())}, fp,
+                        separators=(",", ":"))
+                fp.flush()
+                os.fsync(fp.fileno())
+                os.chmod(fp.name, 0o644) # Temporary files are created private
+                os.replace(fp.name, fn)
+            except:
+                os.unlink(fp.name)
+                raise
+        logging.debug("Wrote %s vessels to %s in %.3f seconds",
+                len(self.vessels), fn, time.time() - stime)
+
+    def runIt(self) -> None: # Called on thread start
+        q = self.queue
+        dt = self.args.latestInterval
+        logging.info("Starting %s dt=%s", self.args.latest, dt)
+        tNext = time.time() + dt
+        changed = False
+        while True:
+            try:
+                msg = q.get(timeout=max(0, tNext - time.time()))
+                q.task_done()
+                changed |= self.update(msg)
+            except queue.Empty:
+                pass
+            now = time.time()
+            if now < tNext: continue
+            tNext = now + dt
+            n = len(self.vessels)
+            self.expire(now)
+            if changed or n != len(self.vessels):
+                try:
+                    self.snapshot(now)
+                except:
+                    logging.exception("Writing %s", self.args.latest)
+            changed = False
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+#
+# Pipeline metrics for aisChomp
+#
+# Counters and latency histograms are updated by the threads as they work,
+# gauges are functions sampled when a report is made, i.e. queue depths.
+# A Stats thread logs one line of rates every --statsInterval seconds,
+# and with --statsPort the full set is served as text over HTTP on localhost.
+#
+from argparse import ArgumentParser
+from TPWUtils import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import logging
+import bisect
+import time
+
+class Histogram:
+    bounds = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1, 3, 10) # Seconds
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.bounds) + 1) # The last bucket is everything larger
+        self.n = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q:float) -> float:
+        # Upper bound of the bucket holding the q'th quantile
+        target = q * self.n
+        total = 0
+        for (bound, cnt) in zip(self.bounds, self.counts):
+            total += cnt
+            if total >= target: return bound
+        return self.max
+
+    def __repr__(self) -> str:
+        if not self.n: return "n=0"
+        return f"n={self.n} mean={self.sum / self.n:.4f} p50<={self.quantile(0.5)}" \
+                + f" p99<={self.quantile(0.99)} max={self.max:.4f}"
+
+class Metrics:
+    __lock = threading.Lock()
+    __counters = {}
+    __histograms = {}
+    __gauges = {}
+
+    @classmethod
+    def count(cls, name:str, n:int=1) -> None:
+        with cls.__lock:
+            cls.__counters[name] = cls.__counters.get(name, 0) + n
+
+    @classmethod
+    def observe(cls, name:str, value:float) -> None:
+        with cls.__lock:
+            if name not in cls.__histograms: cls.__histograms[name] = Histogram()
+            cls.__histograms[name].observe(value)
+
+    @classmethod
+    def gauge(cls, name:str, func) -> None:
+        """ Register a function returning the current value of name """
+        with cls.__lock:
+            cls.__gauges[name] = func
+
+    @classmethod
+    def counters(cls) -> dict:
+        with cls.__lock:
+            return dict(cls.__counters)
+
+    @classmethod
+    def text(cls) -> str:
+        """ Everything, one metric per line """
+        lines = []
+        with cls.__lock:
+            for name in sorted(cls.__counters): lines.append(f"{name} {cls.__counters[name]}")
+            for name in sorted(cls.__histograms): lines.append(f"{name} {cls.__histograms[name]}")
+            gauges = sorted(cls.__gauges.items())
+        for (name, func) in gauges:
+            try:
+                lines.append(f"{name} {func()}")
+            except:
+                logging.exception("Evaluating gauge %s", name)
+        return "\n".join(lines) + "\n"
+
+class Sampler:
+    """ True for every n'th call, so per message logging can be thinned out, 0 is never """
+    def __init__(self, n:int) -> None:
+        self.__n = n
+        self.__cnt = 0
+
+    def __call__(self) -> bool:
+        if self.__n <= 0: return False
+        self.__cnt += 1
+        if self.__cnt < self.__n: return False
+        self.__cnt = 0
+        return True
+
+class Stats(Thread.Thread):
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.Thread.__init__(self, "Stats", args)
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Metrics options")
+        grp.add_argument("--statsInterval", type=float, default=60,
+                help="Seconds between statistics lines, 0 disables them")
+        grp.add_argument("--statsPort", type=int,
+                help="Serve the metrics as text on this localhost HTTP port")
+        grp.add_argument("--logSample", type=int, default=0,
+                help="Log every N'th sentence received and sent, 0 logs none")
+
+    def runIt(self) -> None: # Called on thread start
+        dt = self.args.statsInterval
+        logging.info("Starting dt=%s", dt)
+        previous = Metrics.counters()
+        tPrevious = time.time()
+        while True:
+            time.sleep(dt)
+            current = Metrics.counters()
+            now = time.time()
+            rates = []
+            for name in sorted(current):
+                rate = (current[name] - previous.get(name, 0)) / (now - tPrevious)
+                rates.append(f"{name}={rate:.1f}/s")
+            logging.info("Rates %s", " ".join(rates))
+            (previous, tPrevious) = (current, now)
+
+class StatsHTTP(Thread.Thread):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            body = bytes(Metrics.text(), "UTF-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt:str, *args) -> None:
+            logging.debug(fmt, *args)
+
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.Thread.__init__(self, "StatsHTTP", args)
+
+    def runIt(self) -> None: # Called on thread start
+        addr = ("127.0.0.1", self.args.statsPort)
+        logging.info("Starting %s", addr)
+        with ThreadingHTTPServer(addr, self.Handler) as server:
+            server.serve_forever()
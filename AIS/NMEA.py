@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+#
+# Fast path parsing of !AIVDM/!AIVDO NEMA sentences
+#
+# One combined regular expression splits the fields and locates the checksummed body,
+# then the checksums for a batch of sentences are computed together with numpy
+#
+import re
+import logging
+import heapq
+import numpy as np
+
+def xorChecksum(body:bytes) -> int:
+    aSum = 0
+    for c in body: aSum ^= c
+    return aSum
+
+def xorChecksums(bodies:list[bytes]) -> list[int]:
+    # For small batches numpy's overhead dominates, so XOR byte by byte
+    if len(bodies) < 16: return [xorChecksum(body) for body in bodies]
+    # XOR each body's bytes in one pass over the concatenated bodies,
+    # bodies are never empty since they start with AIVD[MO]
+    buffer = np.frombuffer(b"".join(bodies), dtype=np.uint8)
+    offsets = np.zeros(len(bodies), dtype=np.intp)
+    np.cumsum(np.fromiter(map(len, bodies[:-1]), dtype=np.intp, count=len(bodies) - 1),
+            out=offsets[1:])
+    return np.bitwise_xor.reduceat(buffer, offsets).tolist()
+
+class Parser:
+    # name, nFragments, iFragment, ident, channel, payload, fillbits, checksum
+    __sentence = re.compile(
+            rb"^\s*!(AIVD[MO]),(\d),(\d),(\d?),(\w?),([^,]*),([0-5])[*]([0-9A-Fa-f]{2})\s*$")
+    __ignore = (b"$PFEC,", b"$AIALR,", b"$AIABK,", b"$AITXT,")
+    # Table lookups instead of int() for the single digit and hex checksum fields
+    __digit = {bytes(str(i), "UTF-8"): i for i in range(10)}
+    __hex = {bytes(f"{a}{b}", "UTF-8"): int(f"{a}{b}", 16)
+            for a in "0123456789ABCDEFabcdef" for b in "0123456789ABCDEFabcdef"}
+
+    def __init__(self) -> None:
+        self.nParsed = 0
+        self.nIgnored = 0
+        self.nUnrecognized = 0
+        self.nChecksum = 0 # Checksum failures
+
+    def __repr__(self) -> str:
+        return f"parsed={self.nParsed} ignored={self.nIgnored}" \
+                + f" unrecognized={self.nUnrecognized} checksum={self.nChecksum}"
+
+    def parse(self, line:bytes) -> tuple:
+        return self.parseBatch([line])[0]
+
+    def parseBatch(self, lines:list[bytes]) -> list[tuple]:
+        """ For each sentence return
+            (name, nFragments, iFragment, ident, channel, payload, fillbits)
+            or None if it was rejected
+        """
+        match = self.__sentence.match
+        digit = self.__digit
+        results = [None] * len(lines)
+        found = []
+        bodies = []
+        for index in range(len(lines)):
+            line = lines[index]
+            matches = match(line)
+            if matches:
+                found.append((index, matches))
+                bodies.append(line[matches.start(1):matches.end(7)]) # Between ! and *
+            elif line.lstrip().startswith(self.__ignore):
+                self.nIgnored += 1
+            else:
+                self.nUnrecognized += 1
+                logging.warning("Unrecognized NEMA sentence, %s", line)
+
+        for ((index, matches), body, aSum) in zip(found, bodies, xorChecksums(bodies)):
+            fields = matches.groups()
+            if aSum != self.__hex[fields[7]]:
+                self.nChecksum += 1
+                logging.warning("Checksum mismatch, %s chksum %s != %02X", body, fields[7], aSum)
+                continue
+            results[index] = (
+                fields[0],        # AIVD[MO]
+                digit[fields[1]], # Number of fragments
+                digit[fields[2]], # Fragment number
+                fields[3],        # Multipart identification count
+                fields[4],        # Radio channel, A or 1 -> 161.975MHz, B or 2 -> 162.025MHz
+                fields[5],        # data payload
+                digit[fields[6]], # Number of fill bits
+                )
+        self.nParsed += len(found)
+        return results
+
+class Reassembler:
+    """ Accumulate the fragments of multipart sentences
+
+    Fragments are keyed by (source, channel, ident) so interleaved messages
+    from different receivers or radio channels are not mixed together.
+    Incomplete messages are aged out via a heap ordered by their first fragment's time,
+    and the number of incomplete messages held is bounded.
+    """
+    def __init__(self, maxAge:float=60, maxPartials:int=1000) -> None:
+        self.__maxAge = maxAge
+        self.__maxPartials = maxPartials
+        self.__partials = {} # key -> [seq, tFirst, nFragments, {iFragment: payload}, fillbits]
+        self.__heap = [] # (tFirst, seq, key), stale entries are skipped when popped
+        self.__seq = 0
+        self.nCompleted = 0
+        self.nExpired = 0
+        self.nDuplicates = 0
+        self.nEvicted = 0
+        self.nInvalid = 0
+
+    def __repr__(self) -> str:
+        return f"partials={len(self.__partials)} completed={self.nCompleted}" \
+                + f" expired={self.nExpired} duplicates={self.nDuplicates}" \
+                + f" evicted={self.nEvicted} invalid={self.nInvalid}"
+
+    def __len__(self) -> int:
+        return len(self.__partials)
+
+    def __popOldest(self) -> tuple:
+        # Pop heap entries until one matches a pending message
+        heap = self.__heap
+        partials = self.__partials
+        while heap:
+            (tFirst, seq, key) = heapq.heappop(heap)
+            info = partials.get(key)
+            if info is not None and info[0] == seq:
+                del partials[key]
+                return (key, info)
+        return (None, None)
+
+    def expire(self, now:float) -> None:
+        tMin = now - self.__maxAge
+        heap = self.__heap
+        partials = self.__partials
+        while heap and heap[0][0] < tMin: # Only entries older than tMin, stale or live
+            (tFirst, seq, key) = heapq.heappop(heap)
+            info = partials.get(key)
+            if info is None or info[0] != seq: continue # Completed or restarted
+            del partials[key]
+            self.nExpired += 1
+            logging.debug("Aged out partial message, %s, %s", key, info)
+
+    def add(self, key:tuple, t:float, nFragments:int, iFragment:int,
+            payload:bytes, fillbits:int) -> tuple:
+        """ Add a fragment, returning (payload, fillbits, tFirst) when the message is complete """
+        self.expire(t)
+        if iFragment < 1 or iFragment > nFragments:
+            self.nInvalid += 1
+            return None
+        partials = self.__partials
+        info = partials.get(key)
+        if info is not None and (info[2] != nFragments or iFragment in info[3]):
+            # Repeated fragment or the ident was reused for a new message, so restart
+            self.nDuplicates += 1
+            del partials[key]
+            info = None
+        if info is None:
+            self.__seq += 1
+            info = [self.__seq, t, nFragments, {}, 0]
+            partials[key] = info
+            heapq.heappush(self.__heap, (t, self.__seq, key))
+            while len(partials) > self.__maxPartials:
+                self.__popOldest()
+                self.nEvicted += 1
+        fragments = info[3]
+        fragments[iFragment] = payload
+        if iFragment == nFragments: info[4] = fillbits # Fill bits are on the last fragment
+        if len(fragments) < nFragments: return None
+        del partials[key] # Complete, its heap entry is now stale
+        self.nCompleted += 1
+        return (b"".join(fragments[i] for i in range(1, nFragments + 1)), info[4], info[1])
+
+if __name__ == "__main__":
+    # Benchmark the fast path against the original three regex and byte-wise checksum path
+    from argparse import ArgumentParser
+    import sqlite3
+    import time
+
+    parser = ArgumentParser()
+    parser.add_argument("--db", type=str, default="sample.raw.db", help="SQLite3 raw sentence database")
+    parser.add_argument("--repeat", type=int, default=10, help="Number of passes through the sample")
+    parser.add_argument("--batch", type=int, default=256, help="Sentences per batch for the fast path")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as db:
+        lines = [row[0] for row in db.execute("SELECT msg FROM raw ORDER BY t;")]
+
+    reNEMA = re.compile(rb"^\s*!(AIVD[MO],\d+,\d+,\d?,\w?,.*,[0-5])[*]([0-9A-Za-z]{2})\s*$")
+    reIgnore = re.compile(rb"^\s*[$](PFEC|AI(ALR|ABK|TXT)),")
+    reSentence = re.compile(rb"^(AIVD[MO]),(\d+),(\d+),(\d?),(\w?),(.*),([0-5])$")
+
+    def original(line:bytes) -> tuple:
+        matches = reNEMA.match(line)
+        if not matches:
+            reIgnore.match(line)
+            return None
+        aSum = 0
+        for c in matches[1]: aSum ^= c
+        if aSum != int(str(matches[2], "UTF-8"), 16): return None
+        fields = reSentence.match(matches[1])
+        if not fields: return None
+        return (fields[1], int(fields[2]), int(fields[3]), fields[4], fields[5],
+                fields[6], int(fields[7]))
+
+    nmea = Parser()
+    if [original(line) for line in lines] != nmea.parseBatch(lines):
+        print("WARNING: original and fast path results differ")
+
+    n = len(lines) * args.repeat
+    stime = time.time()
+    for cnt in range(args.repeat):
+        for line in lines: original(line)
+    dtOrig = time.time() - stime
+
+    nmea = Parser()
+    stime = time.time()
+    for cnt in range(args.repeat):
+        for index in range(0, len(lines), args.batch):
+            nmea.parseBatch(lines[index:index + args.batch])
+    dtFast = time.time() - stime
+
+    print(f"{n} sentences")
+    print(f"Original {dtOrig:.3f} seconds {n/dtOrig:.0f} sentences/second")
+    print(f"Fast     {dtFast:.3f} seconds {n/dtFast:.0f} sentences/second")
+    print(f"Speedup  {dtOrig/dtFast:.2f}")
+    print(nmea)
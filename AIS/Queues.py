@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+#
+# Bounded queues between the aisChomp threads,
+# with a selectable policy for what to do when a consumer falls behind
+#
+#  block      -- the producer waits for room in the queue
+#  dropOldest -- the oldest waiting item is discarded to make room
+#  spill      -- items beyond the in memory limit are pickled to a temporary file
+#
+# spill is the default, so one stalled sink, i.e. a PostgreSQL writer, neither stops
+# the reader, and with it every other sink, nor loses data.
+#
+from argparse import ArgumentParser
+from TPWUtils import Thread
+import tempfile
+import pickle
+import shutil
+import logging
+import queue
+import time
+
+class BoundedQueue(queue.Queue):
+    Policies = ("block", "dropOldest", "spill")
+    instances = [] # All the queues, for reporting
+    compactSize = 64 * 1024 * 1024 # Bytes read from a spill file before its space is reclaimed
+
+    def __init__(self, name:str, args:ArgumentParser) -> None:
+        policy = args.queuePolicy
+        for item in args.queueOverride or []: # NAME=POLICY overrides
+            (qName, qPolicy) = item.split("=", 1)
+            if qName == name: policy = qPolicy
+        if policy not in self.Policies:
+            raise ValueError(f"Unknown queue policy {policy} for {name}, must be one of {self.Policies}")
+        if args.queueSize < 1:
+            raise ValueError(f"Queue size must be at least 1, {args.queueSize}")
+        # Only the block policy uses Queue's maxsize, the others manage the limit themselves
+        queue.Queue.__init__(self, maxsize=args.queueSize if policy == "block" else 0)
+        self.name = name
+        self.policy = policy
+        self.limit = args.queueSize
+        self.nPut = 0
+        self.nDropped = 0
+        self.nSpilled = 0
+        self.maxDepth = 0
+        self.__spillDir = args.spillDir
+        self.__spill = None # Temporary file items are spilled to
+        self.__nSpill = 0 # Number of items currently in the spill file
+        self.__readPos = 0
+        self.__writePos = 0
+        BoundedQueue.instances.append(self)
+
+    def __repr__(self) -> str:
+        return f"{self.name} {self.policy} depth={self.qsize()} max={self.maxDepth}" \
+                + f" put={self.nPut} dropped={self.nDropped} spilled={self.nSpilled}"
+
+    @classmethod
+    def addArgs(cls, parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Inter-thread queue options")
+        grp.add_argument("--queueSize", type=int, default=100000,
+                help="Maximum number of items held in memory by each queue")
+        grp.add_argument("--queuePolicy", type=str, default="spill", choices=cls.Policies,
+                help="What to do when a queue is full")
+        grp.add_argument("--queueOverride", type=str, action="append", metavar="NAME=POLICY",
+                help="Policy for a specific consumer, i.e. R2PSQL=spill")
+        grp.add_argument("--spillDir", type=str, default=tempfile.gettempdir(),
+                help="Directory for the spill files of the spill policy")
+        grp.add_argument("--queueReport", type=float, default=600,
+                help="Seconds between queue statistics reports, 0 disables them")
+
+    # The following are called by queue.Queue with self.mutex held
+
+    def _qsize(self) -> int:
+        return len(self.queue) + self.__nSpill
+
+    def _put(self, item) -> None:
+        self.nPut += 1
+        if self.policy == "dropOldest" and len(self.queue) >= self.limit:
+            self.queue.popleft()
+            self.nDropped += 1
+            self.unfinished_tasks -= 1 # put increments this for the item we just dropped
+        if self.policy == "spill" and (self.__nSpill or len(self.queue) >= self.limit):
+            self.__spillItem(item) # Once spilling, keep spilling to preserve the order
+        else:
+            self.queue.append(item)
+        self.maxDepth = max(self.maxDepth, self._qsize())
+
+    def _get(self):
+        item = self.queue.popleft()
+        if self.__nSpill: self.__unspillItem() # Refill from the spill file
+        return item
+
+    def __spillItem(self, item) -> None:
+        if self.__spill is None:
+            self.__spill = tempfile.TemporaryFile(dir=self.__spillDir, prefix=self.name + ".")
+        fp = self.__spill
+        fp.seek(self.__writePos)
+        pickle.dump(item, fp)
+        self.__writePos = fp.tell()
+        self.__nSpill += 1
+        self.nSpilled += 1
+
+    def __unspillItem(self) -> None:
+        fp = self.__spill
+        fp.seek(self.__readPos)
+        self.queue.append(pickle.load(fp))
+        self.__readPos = fp.tell()
+        self.__nSpill -= 1
+        if not self.__nSpill: # Drained, so reclaim the disk space
+            fp.seek(0)
+            fp.truncate()
+            self.__readPos = 0
+            self.__writePos = 0
+        elif self.__readPos >= self.compactSize and self.__readPos >= (self.__writePos - self.__readPos):
+            # A consumer which never quite catches up would grow the file forever,
+            # so copy the unread items to a new file. At least as many bytes have been
+            # read as are copied, so the cost per item is constant.
+            self.__compact()
+
+    def __compact(self) -> None:
+        fp = self.__spill
+        nfp = tempfile.TemporaryFile(dir=self.__spillDir, prefix=self.name + ".")
+        fp.seek(self.__readPos)
+        shutil.copyfileobj(fp, nfp)
+        logging.info("Compacted %s spill file from %s to %s bytes",
+                self.name, self.__writePos, nfp.tell())
+        fp.close()
+        self.__spill = nfp
+        self.__writePos = nfp.tell()
+        self.__readPos = 0
+
+class QueueMonitor(Thread.Thread):
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.Thread.__init__(self, "QMon", args)
+
+    def runIt(self) -> None: # Called on thread start
+        dt = self.args.queueReport
+        logging.info("Starting dt=%s", dt)
+        while True:
+            time.sleep(dt)
+            for q in BoundedQueue.instances: logging.info("%s", q)
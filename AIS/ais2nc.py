@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+#
+# Export decimated AIS vessel tracks to a growing NetCDF file
+#
+# Position reports are read from the typed {aisTable}_position table written by aisChomp.
+# The (mmsi, t) primary key and a grid cell expression index serve
+# "tracks in this box over the last N hours" queries without full scans.
+# Each run appends the positions newer than a watermark stored in the database,
+# re-scanning --margin seconds before it to pick up rows which were committed late,
+# keeping a point only if the vessel moved far enough or enough time passed
+# since the last point kept for that vessel.
+# The last point kept for each vessel is stored next to the watermark, so a run only reads
+# the whole NetCDF file when the stored points do not match it, e.g. after a failed commit.
+
+from argparse import ArgumentParser
+from TPWUtils import Logger
+from TPWUtils import SingleInstance
+import psycopg2 # For PostgreSQL access
+from psycopg2.extras import execute_values
+import logging
+from netCDF4 import Dataset
+import numpy as np
+import math
+import os
+import sys
+import time
+
+class Grid:
+    """ Integer grid cells of size degrees, numbered row by row from (-180, -90) """
+    def __init__(self, size:float) -> None:
+        self.size = size
+        self.nx = math.ceil(360 / size)
+        # Used for both the index and the queries, so they must match exactly
+        self.expr = f"(FLOOR((y+90)/{size})::INTEGER*{self.nx}+FLOOR((x+180)/{size})::INTEGER)"
+
+    def __cell(self, x:float, y:float) -> tuple[int, int]:
+        return (math.floor((y + 90) / self.size), math.floor((x + 180) / self.size))
+
+    def mkIndex(self, tbl:str) -> str:
+        name = f"{tbl}_cell{round(self.size * 1000)}"
+        return f"CREATE INDEX IF NOT EXISTS {name} ON {tbl} ({self.expr}, t);"
+
+    def where(self, lonMin:float, lonMax:float, latMin:float, latMax:float) -> tuple[str, list]:
+        # One range of cells per grid row, then the exact box
+        (row0, col0) = self.__cell(lonMin, latMin)
+        (row1, col1) = self.__cell(lonMax, latMax)
+        ranges = []
+        sqlArgs = []
+        for row in range(row0, row1 + 1):
+            ranges.append(f"{self.expr} BETWEEN %s AND %s")
+            sqlArgs.extend((row * self.nx + col0, row * self.nx + col1))
+        sql = "(" + " OR ".join(ranges) + ") AND x BETWEEN %s AND %s AND y BETWEEN %s AND %s"
+        sqlArgs.extend((lonMin, lonMax, latMin, latMax))
+        return (sql, sqlArgs)
+
+class Decimate:
+    """ Keep a position if the vessel moved minDistance meters or minTime seconds passed """
+    def __init__(self, minDistance:float, minTime:float) -> None:
+        self.__minDistance = minDistance
+        self.__minTime = minTime
+        self.__last = {} # mmsi -> (t, x, y) of the last point kept
+        self.__changed = set() # mmsi whose last point is not stored in the database
+
+    def __len__(self) -> int:
+        return len(self.__last)
+
+    def seed(self, mmsi:np.ndarray, t:np.ndarray, x:np.ndarray, y:np.ndarray) -> None:
+        # Start from the last point kept for each vessel in an existing file
+        for index in np.argsort(t, kind="stable"):
+            key = int(mmsi[index])
+            self.__last[key] = (float(t[index]), float(x[index]), float(y[index]))
+            self.__changed.add(key)
+
+    def restore(self, rows:list[tuple]) -> None:
+        # Start from the (mmsi, t, x, y) stored in the database
+        for (mmsi, t, x, y) in rows:
+            self.__last[mmsi] = (t, x, y)
+
+    def changed(self) -> list[tuple]:
+        # (mmsi, t, x, y) to store in the database
+        return [(mmsi,) + self.__last[mmsi] for mmsi in sorted(self.__changed)]
+
+    def keep(self, mmsi:int, t:float, x:float, y:float) -> bool:
+        last = self.__last.get(mmsi)
+        if last is not None:
+            (t0, x0, y0) = last
+            if t <= t0: return False # Already exported
+            if (t - t0) < self.__minTime:
+                # Equirectangular distance is plenty for thresholds of tens of meters
+                dx = math.radians(x - x0) * math.cos(math.radians((y + y0) / 2))
+                dy = math.radians(y - y0)
+                if 6371000 * math.hypot(dx, dy) < self.__minDistance: return False
+        self.__last[mmsi] = (t, x, y)
+        self.__changed.add(mmsi)
+        return True
+
+class TrackNC:
+    """ Append only NetCDF file of track points along a single unlimited obs dimension """
+    __variables = ( # name, type, units, fill value
+            ("t", "f8", "seconds since 1970-01-01 00:00:00", None),
+            ("mmsi", "i4", None, None),
+            ("lon", "f8", "degrees_east", None),
+            ("lat", "f8", "degrees_north", None),
+            ("sog", "f4", "knots", np.nan),
+            ("cog", "f4", "degrees", np.nan),
+            ("hdg", "f4", "degrees", np.nan),
+            )
+    names = tuple(item[0] for item in __variables)
+
+    def __init__(self, fn:str) -> None:
+        self.fn = fn
+        if not os.path.isfile(fn): self.__build()
+
+    def __len__(self) -> int:
+        with Dataset(self.fn, mode="r") as nc:
+            return nc.dimensions["obs"].size
+
+    def __build(self) -> None:
+        logging.info("Creating %s", self.fn)
+        with Dataset(self.fn, mode="w") as nc:
+            nc.createDimension("obs", None)
+            nc.featureType = "trajectory"
+            for (name, dtype, units, fill) in self.__variables:
+                var = nc.createVariable(name, dtype, ("obs",), zlib=True, chunksizes=(4096,),
+                        fill_value=fill)
+                if units: var.units = units
+            nc.variables["mmsi"].cf_role = "trajectory_id"
+
+    def seed(self, decimate:Decimate) -> None:
+        with Dataset(self.fn, mode="r") as nc:
+            v = nc.variables
+            if v["t"].size:
+                decimate.seed(v["mmsi"][:], v["t"][:], v["lon"][:], v["lat"][:])
+
+    def append(self, rows:list[tuple]) -> None:
+        if not rows: return
+        data = np.array(rows, dtype=float) # NULLs become NaN
+        with Dataset(self.fn, mode="a") as nc:
+            v = nc.variables
+            n = v["t"].size
+            for (index, name) in enumerate(self.names):
+                v[name][n:] = data[:,index]
+
+parser = ArgumentParser()
+Logger.addArgs(parser)
+parser.add_argument("--db", type=str, default="sunrise", help="Input database")
+parser.add_argument("--aisTable", type=str, default="ais",
+        help="AIS table prefix, positions are read from {aisTable}_position")
+parser.add_argument("--watermark", type=str, default="aisExport",
+        help="Table holding the newest time exported to each NetCDF file")
+parser.add_argument("--dryrun", action="store_true", help="Do not commit database changes")
+parser.add_argument("--force", action="store_true", help="Ignore the watermark")
+parser.add_argument("--margin", type=float, default=600,
+        help="Seconds before the watermark to re-scan for positions committed late")
+grp = parser.add_argument_group(description="Selection options")
+grp.add_argument("--box", type=float, nargs=4, metavar=("LONMIN", "LONMAX", "LATMIN", "LATMAX"),
+        help="Only export positions inside this box")
+grp.add_argument("--hours", type=float, help="Only export positions from the last N hours")
+grp.add_argument("--mmsi", type=int, action="append", help="Only export this vessel, may be repeated")
+grp.add_argument("--cell", type=float, default=0.1, help="Grid cell size in degrees for the index")
+grp = parser.add_argument_group(description="Decimation options")
+grp.add_argument("--minDistance", type=float, default=100,
+        help="Meters a vessel must move before another point is kept")
+grp.add_argument("--minTime", type=float, default=600,
+        help="Seconds after which another point is kept even if the vessel has not moved")
+parser.add_argument("nc", type=str, help="Output NetCDF filename")
+args = parser.parse_args()
+
+Logger.mkLogger(args, fmt="%(asctime)s %(levelname)s: %(message)s")
+
+stime = time.time()
+
+tbl = f"{args.aisTable}_position"
+grid = Grid(args.cell)
+fn = os.path.abspath(os.path.expanduser(args.nc))
+
+sqlWatermark = f"CREATE TABLE IF NOT EXISTS {args.watermark} (\n"
+sqlWatermark+= "  filename TEXT PRIMARY KEY,\n"
+sqlWatermark+= "  t DOUBLE PRECISION NOT NULL, -- Newest time exported\n"
+sqlWatermark+= "  n BIGINT -- Observations in the file when t was set\n"
+sqlWatermark+= f"); -- {args.watermark}"
+sqlWatermarkN = f"ALTER TABLE {args.watermark} ADD COLUMN IF NOT EXISTS n BIGINT;" # Older tables
+
+sqlLast = f"CREATE TABLE IF NOT EXISTS {args.watermark}_last (\n"
+sqlLast+= "  filename TEXT,\n"
+sqlLast+= "  mmsi INTEGER,\n"
+sqlLast+= "  t DOUBLE PRECISION NOT NULL, -- Last point kept for this vessel\n"
+sqlLast+= "  x DOUBLE PRECISION NOT NULL,\n"
+sqlLast+= "  y DOUBLE PRECISION NOT NULL,\n"
+sqlLast+= "  PRIMARY KEY(filename, mmsi)\n"
+sqlLast+= f"); -- {args.watermark}_last"
+
+sqlGet = f"SELECT t,n FROM {args.watermark} WHERE filename=%s;"
+sqlSet = f"INSERT INTO {args.watermark} VALUES (%s,%s,%s)"
+sqlSet+= " ON CONFLICT (filename) DO UPDATE SET t = EXCLUDED.t, n = EXCLUDED.n;"
+
+sqlGetLast = f"SELECT mmsi,t,x,y FROM {args.watermark}_last WHERE filename=%s;"
+sqlSetLast = f"INSERT INTO {args.watermark}_last VALUES %s"
+sqlSetLast+= " ON CONFLICT (filename,mmsi) DO UPDATE"
+sqlSetLast+= " SET t = EXCLUDED.t, x = EXCLUDED.x, y = EXCLUDED.y;"
+
+nToFetch = 40000
+
+with SingleInstance.SingleInstance(sys.argv[0] + "/" + fn) as single:
+    nc = TrackNC(fn)
+    decimate = Decimate(args.minDistance, args.minTime)
+
+    with psycopg2.connect(f"dbname={args.db}") as db:
+        try:
+            cur = db.cursor()
+            cur.execute("BEGIN;")
+            cur.execute(sqlWatermark)
+            cur.execute(sqlWatermarkN)
+            cur.execute(sqlLast)
+            cur.execute(grid.mkIndex(tbl))
+            cur.execute("COMMIT;")
+
+            cur.execute(sqlGet, (fn,))
+            row = cur.fetchone()
+            tMin = None if (row is None) or args.force else row[0]
+
+            nObs = len(nc)
+            if (row is not None) and (row[1] == nObs): # Stored points match the file
+                cur.execute(sqlGetLast, (fn,))
+                decimate.restore(cur.fetchall())
+                logging.info("Seeded %s vessels from %s", len(decimate), args.watermark)
+            elif nObs:
+                nc.seed(decimate)
+                logging.info("Seeded %s vessels from %s", len(decimate), fn)
+
+            sql = "SELECT t,mmsi,x,y,sog,cog,true_heading FROM " + tbl
+            sql+= " WHERE x IS NOT NULL AND y IS NOT NULL"
+            sql+= " AND x BETWEEN -180 AND 180 AND y BETWEEN -90 AND 90" # 181/91 are unavailable
+            sqlArgs = []
+            if tMin is not None: # Decimate drops what was already exported
+                sql+= " AND t>%s"
+                sqlArgs.append(tMin - args.margin)
+            if args.hours is not None:
+                sql+= " AND t>=%s"
+                sqlArgs.append(time.time() - args.hours * 3600)
+            if args.mmsi:
+                sql+= " AND mmsi IN (" + ",".join(["%s"] * len(args.mmsi)) + ")"
+                sqlArgs.extend(args.mmsi)
+            if args.box:
+                (sqlBox, boxArgs) = grid.where(*args.box)
+                sql+= " AND " + sqlBox
+                sqlArgs.extend(boxArgs)
+            sql+= " ORDER BY t ASC;"
+            logging.debug("%s %s", sql, sqlArgs)
+
+            cnt = 0
+            nKept = 0
+            tMax = tMin
+            cur.execute(sql, sqlArgs)
+            rows = cur.fetchmany(size=nToFetch)
+            while rows: # Walk through all the chunks
+                cnt += len(rows)
+                kept = []
+                for (t, mmsi, x, y, sog, cog, hdg) in rows:
+                    if hdg == 511: hdg = None # Not available
+                    if decimate.keep(mmsi, t, x, y): kept.append((t, mmsi, x, y, sog, cog, hdg))
+                nc.append(kept)
+                nKept += len(kept)
+                nObs += len(kept)
+                tMax = rows[-1][0] if tMax is None else max(tMax, rows[-1][0])
+                rows = cur.fetchmany(size=nToFetch)
+
+            if cnt == 0:
+                logging.info("No updates to %s took %s seconds", fn, time.time()-stime)
+                sys.exit(0)
+
+            logging.info("Kept %s of %s positions for %s vessels to %s in %s seconds",
+                    nKept, cnt, len(decimate), fn, time.time()-stime)
+            try:
+                cur.execute("BEGIN;")
+                cur.execute(sqlSet, (fn, tMax, nObs))
+                execute_values(cur, sqlSetLast, [(fn,) + item for item in decimate.changed()])
+                if args.dryrun:
+                    db.rollback()
+                else:
+                    db.commit()
+            except:
+                db.rollback()
+                logging.exception("Error executing %s", sqlSet)
+        except SystemExit:
+            pass
+        except:
+            logging.exception("Error exporting %s", fn)
+            sys.exit(1)
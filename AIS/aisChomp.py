@@ -8,97 +8,59 @@
 from argparse import ArgumentParser
 from TPWUtils import Logger
 from TPWUtils import Thread
-import ais # This is part of python3-ais package in Ubuntu
-import re
+from NMEA import Parser as NMEAParser
+from NMEA import Reassembler
+from Queues import BoundedQueue, QueueMonitor
+from Faux import Faux, FauxUDP, FauxSerial
+from Framer import LineFramer
+from Latest import Latest
+from Metrics import Metrics, Sampler, Stats, StatsHTTP
+import Decoder
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sqlite3
 import psycopg2
+from psycopg2.extras import execute_values
 import time
 import socket
-import pty
 import logging
 import queue
 import serial
 import select
+import asyncio
 import os
+import gzip
+import shutil
 import sys
 
-class Faux(Thread.Thread):
-    def __init__(self, name:str, args:ArgumentParser) -> None:
-        Thread.Thread.__init__(self, name, args)
-        self.sentences = []
-
-    @staticmethod
-    def addArgs(parser:ArgumentParser) -> None:
-        grp = parser.add_argument_group(description="Faux options")
-        grp.add_argument("--fauxTime", type=float, default=1, help="Time between AIS prints")
-        grp.add_argument("--fauxDB", type=str, default="sample.raw.db",
-                help="Faux SQLite3 database")
-
-    def pop(self) -> str:
-        if not self.sentences:
-            with sqlite3.connect(self.args.fauxDB) as db:
-                cur = db.cursor()
-                cur.execute("SELECT msg FROM raw ORDER BY t;") # Order for multipart messages
-                for row in cur: self.sentences.append(row[0])
-        return self.sentences.pop()
-
-class FauxUDP(Faux):
-    def __init__(self, args:ArgumentParser) -> None:
-        Faux.__init__(self, "FauxUDP", args)
-        args.udp = args.fauxUDP
-
-    def runIt(self) -> None: # Called on thread start
-        port = self.args.udp
-        dt = self.args.fauxTime
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        tgt = ("127.0.0.1", self.args.udp)
-
-        logging.info("Starting tgt=%s dt=%s", tgt, dt)
-
-        while True:
-            time.sleep(dt)
-            msg = self.pop()
-            logging.info("Sending %s", msg)
-            sock.sendto(msg, tgt)
-
-class FauxSerial(Faux):
-    def __init__(self, args:ArgumentParser) -> None:
-        Faux.__init__(self, "FauxSerial", args)
-        (self.__master, slave) = pty.openpty() # Create a pseudoTTY device pair
-        args.serial = os.ttyname(slave)
-        logging.info("Serial device name %s", args.serial)
-
-
-    def runIt(self) -> None: # Called on thread start
-        master = self.__master
-        dt = self.args.fauxTime
-        logging.info("Starting dt=%s", dt)
-        while True:
-            time.sleep(dt)
-            msg = self.pop()
-            logging.info("Sending %s", msg)
-            os.write(master, msg)
-
 class Reader(Thread.Thread):
     def __init__(self, name:str, args:ArgumentParser) -> None:
         Thread.Thread.__init__(self, name, args)
         self.queues = []
+        self.__sample = Sampler(args.logSample)
 
     def addQueue(self, q:queue.Queue) -> None:
         self.queues.append(q)
 
     def put(self, t:float, ipAddr:str, ipPort:int, msg:bytes) -> None:
         payload = (t, ipAddr, ipPort, msg)
-        logging.info("Put %s %s %s %s", t, ipAddr, ipPort, msg)
+        Metrics.count("received")
+        if self.__sample(): logging.info("Put %s %s %s %s", t, ipAddr, ipPort, msg)
         for q in self.queues: q.put(payload)
 
+    def readLines(self, device:str, fd:int, framer:LineFramer) -> bool:
+        # Read what is available from fd, and send the complete \r\n terminated lines
+        if not framer.readFrom(fd): return False # EOF
+        t = time.time()
+        for line in framer.lines(): self.put(t, device, None, line)
+        return True
+
 class ReadUDP(Reader):
     def __init__(self, args:ArgumentParser) -> None:
         Reader.__init__(self, "ReadUDP", args)
 
     def runIt(self) -> None: # Called on thread start
-        port = self.args.udp
+        port = self.args.udp[0]
         sz = 20 * 85 # A huge upper limit for NEMA sentences
         logging.info("Starting port=%s size=%s", port, sz)
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
@@ -143,46 +105,311 @@ class ReadSerial(Reader):
         grp.add_argument("--serialStopbits", type=float, default=1,
                 choices=sorted(cls.__Stopbits), help="Serial port number of stop bits")
 
-    def runIt(self) -> None: # Called on thread start
-        args = self.args
-        device = args.serial
-        logging.info("Starting %s", device)
-        with serial.Serial(
+    @classmethod
+    def open(cls, args:ArgumentParser, device:str) -> serial.Serial:
+        return serial.Serial(
                 port=device,
                 timeout=0, # Non-blocking, I'll use select to avoid buffering issues
                 baudrate=args.serialBaudrate,
-                bytesize=self.__Bytesizes[args.serialBytesize],
-                parity=self.__Parity[args.serialParity],
-                stopbits=self.__Stopbits[args.serialStopbits],
-                ) as s:
+                bytesize=cls.__Bytesizes[args.serialBytesize],
+                parity=cls.__Parity[args.serialParity],
+                stopbits=cls.__Stopbits[args.serialStopbits],
+                )
+
+    def runIt(self) -> None: # Called on thread start
+        args = self.args
+        device = args.serial[0]
+        logging.info("Starting %s", device)
+        with self.open(args, device) as s:
             logging.info("s %s", s)
-            buffer = bytearray()
+            framer = LineFramer()
             while s.is_open:
                 (rlist, wlist, xlist) = select.select([s], [], [])
-                t = time.time()
                 try:
-                    buffer += s.read(65536) # Read a data
-                    t = time.time()
-                    lines = buffer.split(b"\n")
-                    for line in lines:
-                        if line == b"": continue
-                        if (len(line) > 1) and line[-1:] == b"\r":
-                            self.put(t, None, None, line)
-                    if len(lines):
-                        if lines[-1] == b"" or lines[-1][-1] == "\r":
-                            buffer = bytearray()
-                        else:
-                            buffer = buffer[-len(lines[-1]):]
+                    if not self.readLines(device, s.fileno(), framer): break
                 except Exception as e:
                     logging.exception("While reading serial device")
         raise Exception(f"EOF while reading from {device}")
 
-class RawWriter(Thread.Thread):
+class ReadAsync(Reader):
+    """ Read any number of UDP ports and serial devices from a single asyncio event loop
+
+    Readiness callbacks drain every datagram waiting on a socket before returning to the loop,
+    recvmmsg style, and everything is fed to the same queues as the threaded readers.
+    """
+    def __init__(self, args:ArgumentParser) -> None:
+        Reader.__init__(self, "ReadAsync", args)
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="asyncio input options")
+        grp.add_argument("--asyncio", action="store_true",
+                help="Use the asyncio reader, which is always used for multiple inputs")
+        grp.add_argument("--udpBatch", type=int, default=64,
+                help="Maximum datagrams read from a socket per wakeup")
+
+    def runIt(self) -> None: # Called on thread start
+        asyncio.run(self.__main())
+
+    async def __main(self) -> None:
+        loop = asyncio.get_running_loop()
+        for port in self.args.udp or []: self.__addUDP(loop, port)
+        for device in self.args.serial or []: self.__addSerial(loop, device)
+        self.__eof = loop.create_future() # Set if a serial device goes away
+        await self.__eof
+
+    def __addUDP(self, loop:asyncio.AbstractEventLoop, port:int) -> None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(("", port))
+        logging.info("Listening to UDP port %s", port)
+        loop.add_reader(sock.fileno(), self.__readUDP, sock)
+
+    def __readUDP(self, sock:socket.socket) -> None:
+        sz = 20 * 85 # A huge upper limit for NEMA sentences
+        t = time.time()
+        for cnt in range(self.args.udpBatch):
+            try:
+                (data, (ipAddr, ipPort)) = sock.recvfrom(sz)
+            except BlockingIOError: # Drained
+                break
+            self.put(t, ipAddr, ipPort, data)
+
+    def __addSerial(self, loop:asyncio.AbstractEventLoop, device:str) -> None:
+        s = ReadSerial.open(self.args, device)
+        logging.info("Listening to serial device %s", s)
+        loop.add_reader(s.fileno(), self.__readSerial, loop, s, device, LineFramer())
+
+    def __readSerial(self, loop:asyncio.AbstractEventLoop, s:serial.Serial,
+            device:str, framer:LineFramer) -> None:
+        try:
+            if self.readLines(device, s.fileno(), framer): return
+        except Exception as e:
+            logging.exception("While reading serial device %s", device)
+        loop.remove_reader(s.fileno())
+        s.close()
+        if not self.__eof.done():
+            self.__eof.set_exception(Exception(f"EOF while reading from {device}"))
+
+class Batcher:
+    """ Drain a queue into batches bounded by a row count and a latency deadline """
+    def __init__(self, name:str, q:queue.Queue, args:ArgumentParser) -> None:
+        self.__name = name
+        self.__queue = q
+        self.__size = max(1, args.batchSize)
+        self.__latency = max(0, args.batchLatency)
+        self.__dtReport = args.batchReport
+        self.__reset(time.time())
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Batched database writer options")
+        grp.add_argument("--batchSize", type=int, default=1000,
+                help="Maximum number of queue entries per transaction")
+        grp.add_argument("--batchLatency", type=float, default=1,
+                help="Maximum seconds to spend filling a batch before flushing it")
+        grp.add_argument("--batchReport", type=float, default=600,
+                help="Seconds between batch statistics reports")
+
+    def __reset(self, t:float) -> None:
+        self.__tReport = t + self.__dtReport
+        self.__nBatches = 0
+        self.__nItems = 0
+        self.__nRows = 0
+        self.__nMax = 0
+        self.__dtFlush = 0
+        self.__dtMax = 0
+
+    def get(self) -> list:
+        q = self.__queue
+        items = [q.get()] # Block until something is available
+        q.task_done()
+        tEnd = time.time() + self.__latency
+        while len(items) < self.__size:
+            dt = tEnd - time.time()
+            try: # After the deadline, only take what is already waiting
+                items.append(q.get(timeout=dt) if dt > 0 else q.get_nowait())
+                q.task_done()
+            except queue.Empty:
+                break
+        return items
+
+    def flushed(self, nItems:int, nRows:int, dt:float) -> None:
+        self.__nBatches += 1
+        self.__nItems += nItems
+        self.__nRows += nRows
+        self.__nMax = max(self.__nMax, nItems)
+        self.__dtFlush += dt
+        self.__dtMax = max(self.__dtMax, dt)
+        Metrics.count(self.__name + ".rows", nRows)
+        Metrics.observe(self.__name + ".flush", dt)
+        now = time.time()
+        if now < self.__tReport: return
+        n = self.__nBatches
+        logging.info("%s batches %s items %s rows %s size mean %.1f max %s flush mean %.4f max %.4f",
+                self.__name, n, self.__nItems, self.__nRows,
+                self.__nItems / n, self.__nMax, self.__dtFlush / n, self.__dtMax)
+        self.__reset(now)
+
+class SQLite3:
+    """ Long lived SQLite3 connections shared by the SQLite3 writers """
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="SQLite3 writer options")
+        grp.add_argument("--sqliteJournal", type=str, default="WAL",
+                choices=("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL"),
+                help="SQLite3 journal mode")
+        grp.add_argument("--sqliteSynchronous", type=str, default="NORMAL",
+                choices=("OFF", "NORMAL", "FULL", "EXTRA"),
+                help="SQLite3 synchronous level, how often to fsync")
+
+    @staticmethod
+    def connect(fn:str, args:ArgumentParser) -> sqlite3.Connection:
+        # isolation_level=None so BEGIN/COMMIT are explicit,
+        # statements are compiled once and kept in the connection's statement cache
+        db = sqlite3.connect(fn, isolation_level=None)
+        cursor = db.cursor()
+        cursor.execute(f"PRAGMA journal_mode={args.sqliteJournal};")
+        cursor.execute(f"PRAGMA synchronous={args.sqliteSynchronous};")
+        logging.info("Opened %s journal %s synchronous %s",
+                fn, args.sqliteJournal, args.sqliteSynchronous)
+        return db
+
+class CSVFile:
+    """ Buffered CSV output with optional rotation and compression of closed segments """
+    __Rotations = {"none": None, "hourly": "%Y%m%dT%H", "daily": "%Y%m%d"}
+
+    def __init__(self, fn:str, header:str, args:ArgumentParser) -> None:
+        self.__fn = fn
+        self.__header = header
+        self.__flushSize = args.csvFlushSize
+        self.__flushTime = args.csvFlushTime
+        self.__rotate = self.__Rotations[args.csvRotate]
+        self.__compress = args.csvCompress
+        if self.__compress == "zstd": # Optional dependency, so fail on startup not rotation
+            import zstandard
+        self.__fp = None
+        self.__segment = None
+        self.__buffer = []
+        self.__nBytes = 0
+        self.__tFlush = None
+
+    def __repr__(self) -> str:
+        return f"{self.__fn} rotate={self.__rotate} compress={self.__compress}"
+
+    @classmethod
+    def addArgs(cls, parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="CSV output options")
+        grp.add_argument("--csvFlushSize", type=int, default=65536,
+                help="Buffered bytes before writing to a CSV file")
+        grp.add_argument("--csvFlushTime", type=float, default=10,
+                help="Maximum seconds a line is buffered before writing to a CSV file")
+        grp.add_argument("--csvRotate", type=str, default="none", choices=sorted(cls.__Rotations),
+                help="Start a new timestamped CSV file every hour or day")
+        grp.add_argument("--csvCompress", type=str, default="none", choices=("none", "gzip", "zstd"),
+                help="Compression applied to rotated CSV files once closed")
+
+    def __segmentName(self, t:float) -> str:
+        if not self.__rotate: return self.__fn
+        (root, ext) = os.path.splitext(self.__fn)
+        return f"{root}.{time.strftime(self.__rotate, time.gmtime(t))}{ext}"
+
+    def __open(self, fn:str) -> None:
+        self.close()
+        logging.info("Opening %s", fn)
+        archive = self.__archive(fn)
+        qHeader = not os.path.isfile(fn) or os.path.getsize(fn) == 0
+        if archive and os.path.isfile(archive): qHeader = False # The archive has the header
+        self.__fp = open(fn, "a")
+        self.__segment = fn
+        if qHeader: self.__fp.write(self.__header)
+
+    def __archive(self, fn:str) -> str: # Compressed name of a closed segment, None if not compressed
+        if not self.__rotate or self.__compress == "none": return None
+        return fn + (".gz" if self.__compress == "gzip" else ".zst")
+
+    def __compressSegment(self, fn:str) -> None:
+        ofn = self.__archive(fn)
+        if ofn is None: return
+        try:
+            stime = time.time()
+            # Append, so a segment reopened after a restart adds a member/frame
+            # to its archive rather than replacing it
+            if self.__compress == "gzip":
+                with open(fn, "rb") as ifp, gzip.open(ofn, "ab") as ofp:
+                    shutil.copyfileobj(ifp, ofp)
+            else:
+                import zstandard
+                with open(fn, "rb") as ifp, open(ofn, "ab") as ofp:
+                    zstandard.ZstdCompressor().copy_stream(ifp, ofp)
+            os.unlink(fn)
+            logging.info("Compressed %s to %s in %.2f seconds", fn, ofn, time.time() - stime)
+        except:
+            logging.exception("Error compressing %s", fn)
+
+    def write(self, t:float, line:str) -> None:
+        fn = self.__segmentName(t)
+        if fn != self.__segment:
+            # Segment names sort in time order. A late line, i.e. a multipart message stamped
+            # with its first fragment's time, goes in the current segment, never a closed one
+            if self.__segment is None or fn > self.__segment: self.__open(fn)
+        if not self.__buffer: self.__tFlush = time.time() + self.__flushTime
+        self.__buffer.append(line)
+        self.__nBytes += len(line)
+        if self.__nBytes >= self.__flushSize: self.flush()
+
+    def timeout(self) -> float: # Seconds until buffered lines must be written, None if empty
+        if not self.__buffer: return None
+        return max(0, self.__tFlush - time.time())
+
+    def tick(self) -> None: # Write out buffered lines if they have waited long enough
+        if self.__buffer and time.time() >= self.__tFlush: self.flush()
+
+    def flush(self) -> None:
+        if not self.__buffer: return
+        self.__fp.write("".join(self.__buffer))
+        self.__fp.flush()
+        self.__buffer = []
+        self.__nBytes = 0
+
+    def close(self) -> None:
+        if self.__fp is None: return
+        self.flush()
+        self.__fp.close()
+        self.__fp = None
+        self.__compressSegment(self.__segment)
+        self.__segment = None
+
+class DBWriter(Thread.Thread):
+    """ Base of the threads which insert batches of rows into a database """
+    def insertEach(self, cursor, insert, rows:list[tuple]) -> int:
+        """ After a batch failed, insert its rows one at a time, skipping the bad ones """
+        nGood = 0
+        try:
+            cursor.execute("BEGIN;")
+            for row in rows:
+                try:
+                    cursor.execute("SAVEPOINT row;")
+                    insert(cursor, [row])
+                    cursor.execute("RELEASE SAVEPOINT row;")
+                    nGood += 1
+                except:
+                    cursor.execute("ROLLBACK TO SAVEPOINT row;")
+                    Metrics.count(self.name + ".badRows")
+                    logging.exception("Dropping %s", row)
+            cursor.execute("COMMIT;")
+        except:
+            cursor.execute("ROLLBACK;")
+            logging.exception("Error inserting %s rows one at a time", len(rows))
+            return 0
+        logging.info("Inserted %s of %s rows one at a time", nGood, len(rows))
+        return nGood
+
+class RawWriter(DBWriter):
     def __init__(self, name:str, args:ArgumentParser, rdr:Reader) -> None:
         Thread.Thread.__init__(self, name, args)
-        self.queue = queue.Queue()
+        self.queue = BoundedQueue(name, args)
         rdr.addQueue(self.queue)
-        self.sqlInsert = None
         self.sqlCreate = f"CREATE TABLE IF NOT EXISTS {args.rawTable} (\n"
         self.sqlCreate+= "  t DOUBLE PRECISION, -- UTC seconds\n"
         self.sqlCreate+= "  ipAddr TEXT,\n"
@@ -200,14 +427,16 @@ class RawWriter(Thread.Thread):
         logging.debug("Creating table:\n%s", self.sqlCreate)
         cursor.execute(self.sqlCreate)
 
-    def dbWrite(self, cursor, payload:tuple) -> None:
-        if not self.sqlInsert: return
-        try:
-            payload = (payload[0], payload[1], payload[2], str(payload[3], "UTF-8"))
-            logging.info("%s", payload)
-            cursor.execute(self.sqlInsert, payload)
-        except:
-            logger.exception("Error handling %s", payload)
+    def mkRows(self, payloads:list[tuple]) -> list[tuple]:
+        rows = []
+        for payload in payloads:
+            try:
+                # Some datagrams carry NUL bytes, which PostgreSQL TEXT rejects
+                msg = str(payload[3], "UTF-8").replace("\x00", "")
+                if msg: rows.append((payload[0], payload[1], payload[2], msg))
+            except:
+                logging.exception("Error handling %s", payload)
+        return rows
 
 class Raw2SQLite(RawWriter):
     def __init__(self, args:ArgumentParser, rdr:Reader) -> None:
@@ -220,21 +449,32 @@ class Raw2SQLite(RawWriter):
     def runIt(self) -> None: # Called on thread start
         args = self.args
         tbl = self.args.rawTable
-        self.sqlInsert = f"INSERT OR IGNORE INTO {tbl} VALUES(?,?,?,?);"
-        q = self.queue
+        sql = f"INSERT OR IGNORE INTO {tbl} VALUES(?,?,?,?);"
+        batcher = Batcher(self.name, self.queue, args)
         logging.info("Starting")
-        qCreateTable = True
-        while True:
-            payload = q.get()
-            q.task_done()
-            with sqlite3.connect(args.rawSQLite3) as db:
-                cursor = db.cursor()
-                cursor.execute("BEGIN;")
-                if qCreateTable: 
-                    self.createTable(cursor)
-                    qCreateTable = False
-                self.dbWrite(cursor, payload)
-                cursor.execute("COMMIT;")
+        db = SQLite3.connect(args.rawSQLite3, args)
+        try:
+            cursor = db.cursor()
+            cursor.execute("BEGIN;")
+            self.createTable(cursor)
+            cursor.execute("COMMIT;")
+            while True:
+                payloads = batcher.get()
+                stime = time.time()
+                rows = self.mkRows(payloads)
+                if not rows: continue
+                try:
+                    cursor.execute("BEGIN;")
+                    cursor.executemany(sql, rows)
+                    cursor.execute("COMMIT;")
+                except:
+                    cursor.execute("ROLLBACK;")
+                    Metrics.count(self.name + ".errors")
+                    logging.exception("Error inserting %s rows", len(rows))
+                    self.insertEach(cursor, lambda cur, items: cur.executemany(sql, items), rows)
+                batcher.flushed(len(payloads), len(rows), time.time() - stime)
+        finally:
+            db.close()
 
 class Raw2PostgreSQL(RawWriter):
     def __init__(self, args:ArgumentParser, rdr:Reader) -> None:
@@ -247,21 +487,29 @@ class Raw2PostgreSQL(RawWriter):
     def runIt(self) -> None: # Called on thread start
         args = self.args
         tbl = self.args.rawTable
-        self.sqlInsert = f"INSERT INTO {tbl} VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING;"
-        q = self.queue
+        sql = f"INSERT INTO {tbl} VALUES %s ON CONFLICT DO NOTHING;" # Multi-row insert
+        batcher = Batcher(self.name, self.queue, args)
         logging.info("Starting")
-        qCreateTable = True
         with psycopg2.connect("dbname=" + args.rawPostgreSQL) as db:
+            cursor = db.cursor()
+            cursor.execute("BEGIN;")
+            self.createTable(cursor)
+            cursor.execute("COMMIT;")
             while True:
-                payload = q.get()
-                q.task_done()
-                cursor = db.cursor()
-                cursor.execute("BEGIN;")
-                if qCreateTable:
-                    self.createTable(cursor)
-                    qCreateTable = False
-                self.dbWrite(cursor, payload)
-                cursor.execute("COMMIT;")
+                payloads = batcher.get()
+                stime = time.time()
+                rows = self.mkRows(payloads)
+                if not rows: continue
+                try:
+                    cursor.execute("BEGIN;")
+                    execute_values(cursor, sql, rows, page_size=len(rows))
+                    cursor.execute("COMMIT;")
+                except:
+                    cursor.execute("ROLLBACK;")
+                    Metrics.count(self.name + ".errors")
+                    logging.exception("Error inserting %s rows", len(rows))
+                    self.insertEach(cursor, lambda cur, items: execute_values(cur, sql, items), rows)
+                batcher.flushed(len(payloads), len(rows), time.time() - stime)
 
 class Raw2CSV(RawWriter):
     def __init__(self, args:ArgumentParser, rdr:Reader) -> None:
@@ -272,185 +520,349 @@ class Raw2CSV(RawWriter):
         parser.add_argument("--rawCSV", type=str, help="CSV filename for Raw output")
 
     def runIt(self) -> None: # Called on thread start
-        fn = self.args.rawCSV
         q = self.queue
-        logging.info("Starting %s", fn)
-        if not os.path.isfile(fn):
-            with open(fn, "w") as fp:
-                fp.write("t,ipAddr,port,body\n")
+        csv = CSVFile(self.args.rawCSV, "t,ipAddr,port,body\n", self.args)
+        logging.info("Starting %s", csv)
 
         while True:
-            payload = q.get()
-            q.task_done()
+            try:
+                payload = q.get(timeout=csv.timeout())
+                q.task_done()
+            except queue.Empty: # Time to flush buffered lines
+                csv.tick()
+                continue
             try:
                 (t, ipAddr, port, body) = payload
                 body = str(body, "UTF-8")
-                with open(fn, "a") as fp:
-                    fp.write(f"{t},{ipAddr},{port},'{body}'\n")
+                csv.write(t, f"{t},{ipAddr},{port},'{body}'\n")
             except:
-                logging.exception("Error writing to %s, %s, %s, %s, %s", fn, t, ipAddr, port, body)
+                logging.exception("Error writing to %s, %s", csv, payload)
+            csv.tick()
                 
+def fanOut(results:list, queues:list[queue.Queue]) -> None:
+    nErrors = 0
+    for info in results:
+        if isinstance(info, str): # Error message from the decoder
+            logging.warning("%s", info)
+            nErrors += 1
+            continue
+        for q in queues: q.put(info)
+    Metrics.count("decoded", len(results) - nErrors)
+    Metrics.count("decodeErrors", nErrors)
+
+class DecodeCollector(Thread.Thread):
+    """ Send decoded messages on in the order their batches were submitted to the pool """
+    def __init__(self, args:ArgumentParser, queues:list[queue.Queue]) -> None:
+        Thread.Thread.__init__(self, "Decoded", args)
+        # Futures waiting on the pool, bounded so a slow pool pushes back on Decrypt
+        self.queue = queue.Queue(maxsize=4 * args.decodeProcesses)
+        self.__queues = queues
+
+    def runIt(self) -> None: # Called on thread start
+        logging.info("Starting")
+        q = self.queue
+        while True:
+            (stime, future) = q.get()
+            q.task_done()
+            results = future.result()
+            Metrics.observe("decode", time.time() - stime) # Including the wait for a worker
+            fanOut(results, self.__queues)
+
 class Decrypt(Thread.Thread):
     def __init__(self, args:ArgumentParser, rdr:Reader) -> None:
         Thread.Thread.__init__(self, "Decrypt", args)
-        self.queueIn = queue.Queue()
+        self.queueIn = BoundedQueue("Decrypt", args)
         self.__queues = []
         rdr.addQueue(self.queueIn)
+        # With a pool, decoded messages are sent on by the collector thread
+        self.collector = DecodeCollector(args, self.__queues) if args.decodeProcesses else None
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        parser.add_argument("--decryptBatch", type=int, default=256,
+                help="Maximum number of waiting sentences to parse together")
+        parser.add_argument("--decodeProcesses", type=int, default=0,
+                help="Number of processes to decode AIS payloads in, 0 decodes in the Decrypt thread")
+        parser.add_argument("--partialAge", type=float, default=60,
+                help="Seconds to wait for all the fragments of a multipart message")
+        parser.add_argument("--partialMax", type=int, default=1000,
+                help="Maximum number of incomplete multipart messages to hold")
+        parser.add_argument("--decryptReport", type=float, default=600,
+                help="Seconds between parsing and reassembly statistics reports")
 
     def addQueue(self, q:queue.Queue) -> None:
         self.__queues.append(q)
 
-    def __chkSum(self, body:bytes, chksum:bytes) -> bool:
-        aSum = 0
-        for c in body: aSum ^= c
-        if aSum == int(str(chksum, "UTF-8"), 16): return True
-        logging.warning("Checksum mismatch, %s chksum %s != %s", body, chksum, f"{aSum:02X}")
-        return False
-
-    def __decrypt(self, payload:bytes, fillbits:int, t:float) -> None:
-        try:
-            payload = str(payload, "UTF-8")
-            info = ais.decode(payload, fillbits)
-            info["t"] = t
-            for q in self.__queues: q.put(info)
-        except:
-            logging.exception("Error decoding %s, %s", payload, fillbits)
+    def __getBatch(self) -> list[tuple]:
+        q = self.queueIn
+        items = [q.get()] # Block until something is available
+        q.task_done()
+        while len(items) < self.args.decryptBatch: # Then take whatever else is waiting
+            try:
+                items.append(q.get_nowait())
+                q.task_done()
+            except queue.Empty:
+                break
+        return items
 
     def runIt(self) -> None: # Called on thread start
-        logging.info("Starting")
-        qIn = self.queueIn
-        qOut = self.__queues
-        reNEMA = re.compile(b"^\s*!(AIVD[MO],\d+,\d+,\d?,\w?,.*,[0-5])[*]([0-9A-Za-z]{2})\s*$")
-        reIgnore = re.compile(b"^\s*[$](PFEC|AI(ALR|ABK|TXT)),")
-        reSentence = re.compile(b"^(AIVD[MO]),(\d+),(\d+),(\d?),(\w?),(.*),([0-5])$")
-        partials = {} # For accumulating partial messages
+        nProcs = self.args.decodeProcesses
+        logging.info("Starting decodeProcesses %s", nProcs)
+        pool = None
+        if nProcs > 0:
+            # Other threads are already running, so never fork this process.
+            # The workers only run Decoder.decodeBatch, so that is all the forkserver preloads.
+            # Each worker still imports this script, hence the __main__ guard at the bottom.
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["Decoder"])
+            pool = ProcessPoolExecutor(max_workers=nProcs, mp_context=ctx)
+        nmea = NMEAParser()
+        partials = Reassembler(self.args.partialAge, self.args.partialMax)
+        Metrics.gauge("nmea", nmea.__repr__)
+        Metrics.gauge("reassembly", partials.__repr__)
+        tReport = time.time() + self.args.decryptReport
         while True:
-            payload = qIn.get()
-            qIn.task_done()
-            (t, ipAddr, port, body) = payload
-            matches = reNEMA.match(body)
-            if not matches:
-                if not reIgnore.match(body):
-                    logging.warning("Unrecognized NEMA sentence, %s", body)
-                continue
-            if not self.__chkSum(matches[1], matches[2]): continue
-            fields = reSentence.match(matches[1])
-            if not fields:
-                logging.warning("Unrecognized sentence, %s", matches[1])
-                continue
-            msg = dict(
-                    name       = fields[1],      # AVID[MO]
-                    nFragments = int(fields[2]), # Number of fragments
-                    iFragment  = int(fields[3]), # Fragment Number
-                    ident      = fields[4],      # Multipart identification count
-                               # Radio channel, A or 1 -> 161.975MHz, B or 2 -> 162.025MHz
-                    channel    = fields[5],      
-                    payload    = fields[6],      # data payload
-                    fillbits   = int(fields[7]), # Number of fill bits
-                    )
-            if msg["nFragments"] == 1: # Simple message
-                self.__decrypt(msg["payload"], msg["fillbits"], t)
-                continue
-            # Multipart message
-            ident = msg["ident"]
-            if ident not in partials: partials[ident] = {"payloads": {}, "fillBits": 0, "age": t}
-            info = partials[ident]
-            info["payloads"][msg["iFragment"]] = msg["payload"]
-            if msg["nFragments"] == msg["iFragment"]: info["fillbits"] = msg["fillbits"]
-            if len(info["payloads"]) == msg["nFragments"]: # We are done
-                content = bytearray()
-                for frag in sorted(partials[ident]["payloads"]): content += info["payloads"][frag]
-                self.__decrypt(content, msg["fillbits"], info["age"])
-                del partials[ident]
-            if partials: # Age out partials so we don't have a memory leak
-                tMin = time.time() - 60 # At most 1 minute
-                toDrop = set()
-                for ident in partials:
-                    if partials[ident]["age"] < tMin:
-                        toDrop.add(ident)
-                for ident in toDrop: 
-                    logging.warning("Aged out partial message, %s", partials[ident])
-                    del partials[ident]
-
-class AIS2DB(Thread.Thread):
+            batch = self.__getBatch()
+            (nChecksum, nUnrecognized) = (nmea.nChecksum, nmea.nUnrecognized)
+            sentences = nmea.parseBatch([item[3] for item in batch])
+            Metrics.count("checksumErrors", nmea.nChecksum - nChecksum)
+            Metrics.count("unrecognized", nmea.nUnrecognized - nUnrecognized)
+            complete = [] # (payload, fillbits, t) ready to be decoded
+            for (payload, fields) in zip(batch, sentences):
+                if fields is not None: self.__process(payload, fields, partials, complete)
+            if time.time() >= tReport:
+                logging.info("NMEA %s reassembly %s", nmea, partials)
+                tReport = time.time() + self.args.decryptReport
+            if not complete: continue
+            stime = time.time()
+            if pool is None:
+                results = Decoder.decodeBatch(complete)
+                Metrics.observe("decode", time.time() - stime)
+                fanOut(results, self.__queues)
+            else: # Futures are collected in submission order, so per MMSI order is preserved
+                self.collector.queue.put((stime, pool.submit(Decoder.decodeBatch, complete)))
+
+    def __process(self, item:tuple, fields:tuple, partials:Reassembler, complete:list) -> None:
+        (t, ipAddr, port, body) = item
+        # Radio channel, A or 1 -> 161.975MHz, B or 2 -> 162.025MHz
+        (name, nFragments, iFragment, ident, channel, payload, fillbits) = fields
+        if nFragments == 1: # Simple message
+            complete.append((payload, fillbits, t))
+            return
+        # Multipart message
+        msg = partials.add((ipAddr, port, channel, ident), t, nFragments, iFragment, payload, fillbits)
+        if msg is not None: complete.append(msg)
+
+class AIS2DB(DBWriter):
+    # Typed tables, named {aisTable}_{suffix}, with the message ids they hold
+    # and the decoded fields stored after mmsi and t
+    __tables = {
+            "position": ((1, 2, 3, 18, 19, 27), (
+                ("id", "SMALLINT"), # Message type
+                ("nav_status", "SMALLINT"),
+                ("x", "DOUBLE PRECISION"), # Longitude
+                ("y", "DOUBLE PRECISION"), # Latitude
+                ("sog", "REAL"), # Speed over ground
+                ("cog", "REAL"), # Course over ground
+                ("true_heading", "SMALLINT"),
+                ("rot", "REAL"), # Rate of turn
+                ("position_accuracy", "SMALLINT"),
+                )),
+            "static": ((5, 19, 24), (
+                ("id", "SMALLINT"), # Message type
+                ("part_num", "SMALLINT"), # Message 24 part A/B
+                ("imo_num", "INTEGER"),
+                ("callsign", "TEXT"),
+                ("name", "TEXT"),
+                ("type_and_cargo", "SMALLINT"),
+                ("dim_a", "SMALLINT"),
+                ("dim_b", "SMALLINT"),
+                ("dim_c", "SMALLINT"),
+                ("dim_d", "SMALLINT"),
+                ("draught", "REAL"),
+                ("destination", "TEXT"),
+                )),
+            "base": ((4, 11), (
+                ("id", "SMALLINT"), # Message type
+                ("year", "SMALLINT"),
+                ("month", "SMALLINT"),
+                ("day", "SMALLINT"),
+                ("hour", "SMALLINT"),
+                ("minute", "SMALLINT"),
+                ("second", "SMALLINT"),
+                ("x", "DOUBLE PRECISION"), # Longitude
+                ("y", "DOUBLE PRECISION"), # Latitude
+                ("position_accuracy", "SMALLINT"),
+                ("fix_type", "SMALLINT"),
+                )),
+            }
+
     def __init__(self, name:str, args:ArgumentParser, decrypt:Decrypt) -> None:
         Thread.Thread.__init__(self, name, args)
-        self.queue = queue.Queue()
+        self.queue = BoundedQueue(name, args)
         decrypt.addQueue(self.queue)
-        self.sqlInsert = None
-        self.sqlCreate = f"CREATE TABLE IF NOT EXISTS {args.aisTable} (\n"
-        self.sqlCreate+= "  mmsi TEXT, -- AIS unique identifier\n"
-        self.sqlCreate+= "  key TEXT, -- Field name in AIS message\n"
-        self.sqlCreate+= "  t DOUBLE PRECISION, -- UTC seconds\n"
-        self.sqlCreate+= "  value TEXT, -- field value\n"
-        self.sqlCreate+= "  PRIMARY KEY(mmsi, key, t)\n"
-        self.sqlCreate+= f"); -- {args.aisTable}"
+        self.sqlInsert = {} # Filled in by the database specific classes
+        self.sqlCreate = {}
+        self.columns = {} # Number of columns in each table
+        self.__typed = {} # Message id to typed tables and their keys
+
+        if args.aisSchema in ("eav", "both"):
+            tbl = args.aisTable
+            sql = f"CREATE TABLE IF NOT EXISTS {tbl} (\n"
+            sql+= "  mmsi TEXT, -- AIS unique identifier\n"
+            sql+= "  key TEXT, -- Field name in AIS message\n"
+            sql+= "  t DOUBLE PRECISION, -- UTC seconds\n"
+            sql+= "  value TEXT, -- field value\n"
+            sql+= "  PRIMARY KEY(mmsi, key, t)\n"
+            sql+= f"); -- {tbl}"
+            self.sqlCreate[tbl] = [sql]
+            self.columns[tbl] = 4
+        self.__eav = args.aisTable if args.aisSchema in ("eav", "both") else None
+
+        if args.aisSchema in ("typed", "both"):
+            for (suffix, (ids, fields)) in AIS2DB.__tables.items():
+                tbl = f"{args.aisTable}_{suffix}"
+                sql = f"CREATE TABLE IF NOT EXISTS {tbl} (\n"
+                sql+= "  mmsi INTEGER NOT NULL, -- AIS unique identifier\n"
+                sql+= "  t DOUBLE PRECISION NOT NULL, -- UTC seconds\n"
+                for (key, sqlType) in fields: sql+= f"  {key} {sqlType},\n"
+                sql+= "  PRIMARY KEY(mmsi, t)\n"
+                sql+= f"); -- {tbl}"
+                self.sqlCreate[tbl] = [sql, f"CREATE INDEX IF NOT EXISTS {tbl}_t ON {tbl}(t);"]
+                self.columns[tbl] = len(fields) + 2
+                keys = tuple(item[0] for item in fields)
+                for ident in ids:
+                    if ident not in self.__typed: self.__typed[ident] = []
+                    self.__typed[ident].append((tbl, keys))
 
     @staticmethod
     def addArgs(parser:ArgumentParser) -> None:
-        parser.add_argument("--aisTable", type=str, default="ais", help="AIS table name")
+        parser.add_argument("--aisTable", type=str, default="ais",
+                help="AIS table name, and prefix of the typed table names")
+        parser.add_argument("--aisSchema", type=str, default="eav", choices=("eav", "typed", "both"),
+                help="Store decoded messages as key/value rows, typed per message columns, or both")
 
     def createTable(self, cursor) -> None:
-        logging.debug("Creating table:\n%s", self.sqlCreate)
-        cursor.execute(self.sqlCreate)
+        for tbl in self.sqlCreate:
+            for sql in self.sqlCreate[tbl]:
+                logging.debug("Creating table:\n%s", sql)
+                cursor.execute(sql)
 
-    def dbWrite(self, cursor, info:dict) -> None:
-        if "t" not in info: return
-        if "mmsi" not in info: return
-        sql = self.sqlInsert
-        mmsi = info["mmsi"]
-        t = info["t"]
-        for key in info: cursor.execute(sql, (mmsi, key, t, str(info[key])))
+    @staticmethod
+    def __value(val):
+        if isinstance(val, str): return val.strip("@ ") # AIS strings are padded with @
+        return val
+
+    def mkRows(self, msgs:list[dict]) -> dict:
+        rows = {tbl: [] for tbl in self.sqlCreate}
+        eav = self.__eav
+        typed = self.__typed
+        for info in msgs:
+            if "t" not in info: continue
+            if "mmsi" not in info: continue
+            mmsi = info["mmsi"]
+            t = info["t"]
+            if eav:
+                for key in info: rows[eav].append((mmsi, key, t, str(info[key])))
+            if info.get("id") in typed:
+                for (tbl, keys) in typed[info["id"]]:
+                    row = [mmsi, t]
+                    for key in keys: row.append(self.__value(info.get(key)))
+                    rows[tbl].append(tuple(row))
+        return rows
+
+    @staticmethod
+    def flatten(rows:dict) -> list[tuple]:
+        """ {tbl: [row, ...]} to [(tbl, row), ...] for insertEach """
+        return [(tbl, row) for tbl in rows for row in rows[tbl]]
 
 class AIS2SQLite3(AIS2DB):
     def __init__(self, args:ArgumentParser, decrypt:Decrypt) -> None:
         AIS2DB.__init__(self, "AIS2SQLite", args, decrypt)
-        self.sqlInsert = f"INSERT OR IGNORE INTO {args.aisTable} VALUES(?,?,?,?);"
+        for (tbl, n) in self.columns.items():
+            self.sqlInsert[tbl] = f"INSERT OR IGNORE INTO {tbl} VALUES(" + ",".join(["?"] * n) + ");"
 
     @staticmethod
     def addArgs(parser:ArgumentParser) -> None:
         parser.add_argument("--aisSQLite3", type=str, help="SQLite3 database")
 
     def runIt(self) -> None: # Called on thread start
-        q = self.queue
+        args = self.args
+        sql = self.sqlInsert
+        batcher = Batcher(self.name, self.queue, args)
         logging.info("Starting")
-        qCreateTable = True
-        while True:
-            msg = q.get()
-            q.task_done()
-            with sqlite3.connect(args.aisSQLite3) as db:
-                cursor = db.cursor()
-                cursor.execute("BEGIN;")
-                if qCreateTable: 
-                    self.createTable(cursor)
-                    qCreateTable = False
-                self.dbWrite(cursor, msg)
-                cursor.execute("COMMIT;")
+
+        def insert(cur, items:list[tuple]) -> None: # (tbl, row) pairs from flatten
+            for (tbl, row) in items: cur.execute(sql[tbl], row)
+
+        db = SQLite3.connect(args.aisSQLite3, args)
+        try:
+            cursor = db.cursor()
+            cursor.execute("BEGIN;")
+            self.createTable(cursor)
+            cursor.execute("COMMIT;")
+            while True:
+                msgs = batcher.get()
+                stime = time.time()
+                rows = self.mkRows(msgs)
+                n = sum(map(len, rows.values()))
+                if not n: continue
+                try:
+                    cursor.execute("BEGIN;")
+                    for tbl in rows:
+                        if rows[tbl]: cursor.executemany(sql[tbl], rows[tbl])
+                    cursor.execute("COMMIT;")
+                except:
+                    cursor.execute("ROLLBACK;")
+                    Metrics.count(self.name + ".errors")
+                    logging.exception("Error inserting %s rows", n)
+                    self.insertEach(cursor, insert, self.flatten(rows))
+                batcher.flushed(len(msgs), n, time.time() - stime)
+        finally:
+            db.close()
 
 class AIS2PostgreSQL(AIS2DB):
     def __init__(self, args:ArgumentParser, decrypt:Decrypt) -> None:
         AIS2DB.__init__(self, "AIS2PSQL", args, decrypt)
-        self.sqlInsert = f"INSERT INTO {args.aisTable} VALUES(%s,%s,%s,%s) ON CONFLICT DO NOTHING;"
+        for tbl in self.columns: # Multi-row insert via execute_values
+            self.sqlInsert[tbl] = f"INSERT INTO {tbl} VALUES %s ON CONFLICT DO NOTHING;"
 
     @staticmethod
     def addArgs(parser:ArgumentParser) -> None:
         parser.add_argument("--aisPostgreSQL", type=str, help="PostgreSQL database")
 
     def runIt(self) -> None: # Called on thread start
-        q = self.queue
+        args = self.args
+        sql = self.sqlInsert
+        batcher = Batcher(self.name, self.queue, args)
         logging.info("Starting")
-        qCreateTable = True
+
+        def insert(cur, items:list[tuple]) -> None: # (tbl, row) pairs from flatten
+            for (tbl, row) in items: execute_values(cur, sql[tbl], [row])
+
         with psycopg2.connect("dbname=" + args.aisPostgreSQL) as db:
+            cursor = db.cursor()
+            cursor.execute("BEGIN;")
+            self.createTable(cursor)
+            cursor.execute("COMMIT;")
             while True:
-                msg = q.get()
-                q.task_done()
-                cursor = db.cursor()
-                cursor.execute("BEGIN;")
-                if qCreateTable: 
-                    self.createTable(cursor)
-                    qCreateTable = False
-                self.dbWrite(cursor, msg)
-                cursor.execute("COMMIT;")
+                msgs = batcher.get()
+                stime = time.time()
+                rows = self.mkRows(msgs)
+                n = sum(map(len, rows.values()))
+                if not n: continue
+                try:
+                    cursor.execute("BEGIN;")
+                    for tbl in rows:
+                        if rows[tbl]:
+                            execute_values(cursor, sql[tbl], rows[tbl], page_size=len(rows[tbl]))
+                    cursor.execute("COMMIT;")
+                except:
+                    cursor.execute("ROLLBACK;")
+                    Metrics.count(self.name + ".errors")
+                    logging.exception("Error inserting %s rows", n)
+                    self.insertEach(cursor, insert, self.flatten(rows))
+                batcher.flushed(len(msgs), n, time.time() - stime)
 
 class AIS2CSV(AIS2DB):
     def __init__(self, args:ArgumentParser, decrypt:Decrypt) -> None:
@@ -462,66 +874,91 @@ class AIS2CSV(AIS2DB):
 
     def runIt(self) -> None: # Called on thread start
         q = self.queue
-        fn = self.args.aisCSV
-        logging.info("Starting %s", fn)
         fields = ["t", "mmsi", "x", "y", "sog", "cog"]
-        if not os.path.isfile(fn):
-            with open(fn, "w") as fp: fp.write(",".join(fields) + "\n")
+        csv = CSVFile(self.args.aisCSV, ",".join(fields) + "\n", self.args)
+        logging.info("Starting %s", csv)
 
         while True:
-            msg = q.get()
-            q.task_done()
+            try:
+                msg = q.get(timeout=csv.timeout())
+                q.task_done()
+            except queue.Empty: # Time to flush buffered lines
+                csv.tick()
+                continue
             items = []
             for key in fields: items.append(str(msg[key]) if key in msg else "")
-            with open(fn, "a") as fp: fp.write(",".join(items) + "\n")
-
-parser = ArgumentParser()
-Logger.addArgs(parser)
-Faux.addArgs(parser)
-ReadSerial.addArgs(parser)
-RawWriter.addArgs(parser)
-Raw2SQLite.addArgs(parser)
-Raw2PostgreSQL.addArgs(parser)
-Raw2CSV.addArgs(parser)
-AIS2DB.addArgs(parser)
-AIS2SQLite3.addArgs(parser)
-AIS2PostgreSQL.addArgs(parser)
-AIS2CSV.addArgs(parser)
-grp = parser.add_mutually_exclusive_group(required=True)
-grp.add_argument("--udp", type=int, help="UDP port to listen to for datagrams")
-grp.add_argument("--serial", type=str, help="Serial port to listen to")
-grp.add_argument("--fauxUDP", type=int, help="Send faux UDP datagrams to myself")
-grp.add_argument("--fauxSerial", action="store_true",
-    help="Send faux NEMA sentences to myself via a serial connection")
-args = parser.parse_args()
-
-Logger.mkLogger(args)
-
-thrds = []
-if args.fauxUDP:
-    thrds.append(FauxUDP(args))
-elif args.fauxSerial:
-    thrds.append(FauxSerial(args))
-logging.info("args %s", args)
-
-if args.udp:
-    rdr = ReadUDP(args)
-    thrds.append(rdr)
-elif args.serial:
-    rdr = ReadSerial(args)
+            csv.write(msg["t"] if "t" in msg else time.time(), ",".join(items) + "\n")
+            csv.tick()
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    Logger.addArgs(parser)
+    Faux.addArgs(parser)
+    ReadSerial.addArgs(parser)
+    ReadAsync.addArgs(parser)
+    BoundedQueue.addArgs(parser)
+    Batcher.addArgs(parser)
+    SQLite3.addArgs(parser)
+    RawWriter.addArgs(parser)
+    Raw2SQLite.addArgs(parser)
+    Raw2PostgreSQL.addArgs(parser)
+    Raw2CSV.addArgs(parser)
+    CSVFile.addArgs(parser)
+    Decrypt.addArgs(parser)
+    AIS2DB.addArgs(parser)
+    AIS2SQLite3.addArgs(parser)
+    AIS2PostgreSQL.addArgs(parser)
+    AIS2CSV.addArgs(parser)
+    Latest.addArgs(parser)
+    Stats.addArgs(parser)
+    parser.add_argument("--udp", type=int, action="append",
+        help="UDP port to listen to for datagrams, may be repeated")
+    parser.add_argument("--serial", type=str, action="append",
+        help="Serial port to listen to, may be repeated")
+    grp = parser.add_mutually_exclusive_group()
+    grp.add_argument("--fauxUDP", type=int, help="Send faux UDP datagrams to myself")
+    grp.add_argument("--fauxSerial", action="store_true",
+        help="Send faux NEMA sentences to myself via a serial connection")
+    args = parser.parse_args()
+
+    if not (args.udp or args.serial or args.fauxUDP or args.fauxSerial):
+        parser.error("One of --udp, --serial, --fauxUDP, or --fauxSerial is required")
+
+    Logger.mkLogger(args)
+
+    thrds = []
+    if args.fauxUDP:
+        thrds.append(FauxUDP(args))
+    elif args.fauxSerial:
+        thrds.append(FauxSerial(args))
+    logging.info("args %s", args)
+
+    if args.asyncio or (len(args.udp or []) + len(args.serial or [])) > 1:
+        rdr = ReadAsync(args)
+    elif args.udp:
+        rdr = ReadUDP(args)
+    else:
+        rdr = ReadSerial(args)
     thrds.append(rdr)
 
-if args.rawSQLite3: thrds.append(Raw2SQLite(args, rdr))
-if args.rawPostgreSQL: thrds.append(Raw2PostgreSQL(args, rdr))
-if args.rawCSV: thrds.append(Raw2CSV(args, rdr))
+    if args.rawSQLite3: thrds.append(Raw2SQLite(args, rdr))
+    if args.rawPostgreSQL: thrds.append(Raw2PostgreSQL(args, rdr))
+    if args.rawCSV: thrds.append(Raw2CSV(args, rdr))
+
+    if args.aisCSV or args.aisSQLite3 or args.aisPostgreSQL or args.latest:
+        decoder = Decrypt(args, rdr)
+        thrds.append(decoder)
+        if decoder.collector: thrds.append(decoder.collector)
+        if args.aisCSV: thrds.append(AIS2CSV(args, decoder))
+        if args.aisSQLite3: thrds.append(AIS2SQLite3(args, decoder))
+        if args.aisPostgreSQL: thrds.append(AIS2PostgreSQL(args, decoder))
+        if args.latest: thrds.append(Latest(args, decoder))
 
-if args.aisCSV or args.aisSQLite3 or args.aisPostgreSQL:
-    decoder = Decrypt(args, rdr)
-    thrds.append(decoder)
-    if args.aisCSV: thrds.append(AIS2CSV(args, decoder))
-    if args.aisSQLite3: thrds.append(AIS2SQLite3(args, decoder))
-    if args.aisPostgreSQL: thrds.append(AIS2PostgreSQL(args, decoder))
+    if args.queueReport > 0: thrds.append(QueueMonitor(args))
+    for q in BoundedQueue.instances: Metrics.gauge("queue." + q.name, q.__repr__)
+    if args.statsInterval > 0: thrds.append(Stats(args))
+    if args.statsPort: thrds.append(StatsHTTP(args))
 
-for thrd in thrds: thrd.start() # Start all the threads
+    for thrd in thrds: thrd.start() # Start all the threads
 
-Thread.Thread.waitForException()
+    Thread.Thread.waitForException()
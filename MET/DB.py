@@ -38,6 +38,7 @@ class DB(Thread):
             self.__filepos.mkTable(cur) # Create the filePosition table
             self.__config.mkTable(cur) # Create met table
             cur.execute("COMMIT;")
+            self.__filepos.load(cur) # Cache the file positions
 
     def __populateHeaders(self, fn:str) -> tuple[list[str], int]:
         fields = []
@@ -80,13 +81,16 @@ class DB(Thread):
         if spos == epos: # Nothing happened
             logging.info("Nothing processed from %s", fn)
             cur.execute("ROLLBACK;")
+            self.__filepos.committed() # Nothing to write, but remember its size and mtime
         else:
             if self.__filepos.set(fn, epos, cur):
                 logging.info("Processed %s rows from %s", cnt, fn)
                 cur.execute("COMMIT;")
+                self.__filepos.committed()
             else:
                 logging.warning("Failed setting fileposition for %s", fn)
                 cur.execute("ROLLBACK;")
+                self.__filepos.rolledBack()
         return epos
 
     def runIt(self) -> None: # Called on thread start
@@ -102,11 +106,16 @@ class DB(Thread):
         while True:
             fn = q.get()
             q.task_done()
+            self.__filepos.rolledBack() # Discard anything left from a failed pass
+            if not self.__filepos.changed(fn): # Same size and mtime as the last successful pass
+                logging.info("Unchanged %s", fn)
+                continue
             with psycopg2.connect(dbname) as db:
                 cur = db.cursor()
                 posDB = self.__filepos.get(fn, cur)
                 if posDB and (posDB == os.path.getsize(fn)): 
                     logging.info("Already fully processed %s", fn)
+                    self.__filepos.committed() # Remember its size and mtime
                     continue # Nothing new get get
                 if fn not in header:
                     (header[fn], posHeader[fn]) = self.__populateHeaders(fn)
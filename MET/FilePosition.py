@@ -2,8 +2,12 @@
 #
 # PostgreSQL table of file positions
 #
+# The table is loaded into memory once, and updates are written through to the cache
+# when their transaction commits. The size and modification time of each file at its
+# last successful pass lets unchanged files be skipped without touching the database.
+#
 import logging
-import os.path
+import os
 
 class FilePosition:
     def __init__(self, table:str="filePosition") -> None:
@@ -18,13 +22,50 @@ class FilePosition:
         self.__set+= " ON CONFLICT (filename)"
         self.__set+= " DO UPDATE SET position = EXCLUDED.position;"
 
+        self.__load = f"SELECT filename,position FROM {table};"
+
+        self.__cache = None # filename -> position, None until loaded
+        self.__stats = {} # filename -> (size, mtime) at the last successful pass
+        self.__pending = {} # filename -> position set in the current transaction
+        self.__pendingStats = {} # filename -> (size, mtime) seen in the current transaction
+
         logging.info("FilePos\n%s\n%s\n%s", self.__create, self.__get, self.__set)
 
     def mkTable(self, cur) -> None:
         cur.execute(self.__create)
 
+    def load(self, cur) -> None:
+        cur.execute(self.__load)
+        self.__cache = {row[0]: row[1] for row in cur}
+        logging.info("Loaded %s file positions", len(self.__cache))
+
+    def changed(self, fn:str) -> bool:
+        """ Has fn changed since its last successful pass? """
+        fn = os.path.abspath(os.path.expanduser(fn))
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return False
+        stat = (st.st_size, st.st_mtime_ns)
+        if self.__stats.get(fn) == stat: return False
+        self.__pendingStats[fn] = stat
+        return True
+
+    def committed(self) -> None:
+        """ The transaction holding the set calls was committed, so update the cache """
+        if self.__cache is not None: self.__cache.update(self.__pending)
+        self.__stats.update(self.__pendingStats)
+        self.__pending.clear()
+        self.__pendingStats.clear()
+
+    def rolledBack(self) -> None:
+        self.__pending.clear()
+        self.__pendingStats.clear()
+
     def get(self, fn:str, cur) -> int:
         fn = os.path.abspath(os.path.expanduser(fn))
+        if fn in self.__pending: return self.__pending[fn]
+        if self.__cache is not None: return self.__cache.get(fn)
         cur.execute(self.__get, (fn,))
         for row in cur:
             return row[0]
@@ -34,6 +75,7 @@ class FilePosition:
         try:
             fn = os.path.abspath(os.path.expanduser(fn))
             cur.execute(self.__set, (fn, pos))
+            self.__pending[fn] = pos
             return True
         except:
             logging.exception("Trying to set fn=%s pos=%s", fn, pos)
@@ -57,11 +99,14 @@ if __name__ == "__main__":
         cur.execute("BEGIN;")
         fp.mkTable(cur)
         cur.execute("COMMIT;")
+        fp.load(cur)
         print("fn", args.filename, "get", fp.get(fn, cur))
         if args.set is not None:
             cur.execute("BEGIN;")
             if fp.set(fn, args.set, cur):
                 cur.execute("COMMIT;")
+                fp.committed()
             else:
                 cur.execute("ROLLBACK;")
+                fp.rolledBack()
             print("fn", args.filename, "get", fp.get(fn, cur))
@@ -13,11 +13,79 @@ import logging
 from TPWUtils.INotify import INotify
 import pyinotify
 import queue
+import heapq
 import re
 import os
 import time
 import sys
 
+class Debouncer:
+    """ Files waiting for their updates to settle, kept in a heap ordered by deadline
+
+    A file is sent interval seconds after its last update, but never more than
+    maxWait seconds after the first update, so a file which is always changing still gets sent.
+    Each pending file has exactly one heap entry. When a later update pushes a file's deadline
+    out, its entry is only moved once it reaches the top of the heap, so updates are O(1)
+    and sending is O(log n) in the number of pending files.
+    """
+    def __init__(self, dt:float, maxWait:float=None, intervals:list[str]=None) -> None:
+        self.dt = dt # Default seconds to wait
+        self.maxWait = maxWait # None is the file's interval, i.e. sent interval after the first update
+        self.__intervals = [] # (compiled pattern, seconds), first match wins
+        for item in intervals or []:
+            (pattern, sep, seconds) = item.rpartition("=")
+            if not sep: raise ValueError(f"Debounce interval must be PATTERN=SECONDS, {item}")
+            self.__intervals.append((re.compile(pattern), float(seconds)))
+        self.__cache = {} # filename -> seconds to wait
+        self.__pending = {} # filename -> (deadline, latest deadline)
+        self.__heap = [] # (deadline, filename)
+
+    def __repr__(self) -> str:
+        items = [f"{pattern.pattern}={dt}" for (pattern, dt) in self.__intervals]
+        return f"dt={self.dt} maxWait={self.maxWait} intervals={items}"
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def interval(self, fn:str) -> float:
+        """ Seconds to wait after an update of fn """
+        if fn not in self.__cache:
+            name = os.path.basename(fn)
+            self.__cache[fn] = next(
+                    (dt for (pattern, dt) in self.__intervals if pattern.search(name)), self.dt)
+        return self.__cache[fn]
+
+    def update(self, fn:str, t:float) -> None:
+        """ fn was updated at time t """
+        dt = self.interval(fn)
+        if fn in self.__pending:
+            (deadline, tMax) = self.__pending[fn]
+            self.__pending[fn] = (max(deadline, min(t + dt, tMax)), tMax)
+            return
+        logging.debug("Adding %s", fn)
+        deadline = t + dt
+        tMax = t + max(dt, self.maxWait or 0)
+        self.__pending[fn] = (deadline, tMax)
+        heapq.heappush(self.__heap, (deadline, fn))
+
+    def next(self) -> float:
+        """ Earliest time a file might be ready, None if nothing is pending """
+        return self.__heap[0][0] if self.__heap else None
+
+    def ready(self, now:float) -> list[str]:
+        """ Remove and return the files whose deadlines have passed """
+        heap = self.__heap
+        files = []
+        while heap and heap[0][0] <= now:
+            (t, fn) = heapq.heappop(heap)
+            deadline = self.__pending[fn][0]
+            if deadline > t: # Updated since this entry was pushed
+                heapq.heappush(heap, (deadline, fn))
+                continue
+            del self.__pending[fn]
+            files.append(fn)
+        return files
+
 class Monitor(Thread):
     def __init__(self, name:str, args:ArgumentParser, config:Config):
         Thread.__init__(self, name, args)
@@ -25,9 +93,18 @@ class Monitor(Thread):
         self.pattern = None if config is None else config.regexp # compiled pattern
         # Seconds after an update before starting any actions
         self.dt = 10 if config is None else config.timeToWait
+        self.debouncer = Debouncer(self.dt, args.maxWait, args.debounce)
 
     def __repr__(self) -> str:
-        return f"dt={self.dt} pattern={self.pattern}"
+        return f"{self.debouncer} pattern={self.pattern}"
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Update debouncing options")
+        grp.add_argument("--debounce", type=str, action="append", metavar="PATTERN=SECONDS",
+                help="Seconds to wait after an update of files matching PATTERN, may be repeated")
+        grp.add_argument("--maxWait", type=float,
+                help="Most seconds to wait after a file's first update while it keeps changing")
 
     def addQueue(self, queue:queue.Queue) -> None:
         self.__queues.append(queue)
@@ -42,36 +119,20 @@ class MonitorINotify(Monitor):
         self.__qIn = queue
 
     def runIt(self) -> None: # Called on thread start
-        dt = self.dt
         q = self.__qIn
         pattern = self.pattern
+        debouncer = self.debouncer
         logging.info("Starting %s", self)
-        pending = {}
-        tNext = None
         while True:
+            tNext = debouncer.next()
             try:
-                (t, fn) = q.get(timeout=None if tNext is None else max(0.1, tNext - time.time()))
+                (t, fn) = q.get(timeout=None if tNext is None else max(0, tNext - time.time()))
                 q.task_done()
                 if pattern and not pattern.match(os.path.basename(fn)): continue
-                if fn not in pending:
-                    logging.debug("Adding %s", fn)
-                    pending[fn] = t + dt
-                    tNext = t if tNext is None else min(tNext, pending[fn])
-            except queue.Empty: # Timed out, so see which files need to have notifications sent
-                now = time.time() + 0.1
-                toDrop = set()
-                tNext = None
-                for fn in pending: 
-                    if pending[fn] <= now:
-                        toDrop.add(fn)
-                    elif tNext is None:
-                        tNext = pending[fn]
-                    else:
-                        tNext = min(pending[fn], tNext)
-
-                for fn in toDrop: 
-                    del pending[fn]
-                    self.send(fn)
+                debouncer.update(fn, t)
+            except queue.Empty: # Timed out, so the first file in the heap may be ready
+                pass
+            for fn in debouncer.ready(time.time()): self.send(fn)
 
 class MonitorPolling(Monitor):
     def __init__(self, args:ArgumentParser, dirname:str, config:Config) -> None:
@@ -98,7 +159,7 @@ class MonitorPolling(Monitor):
                 if fn in mtimes and mtimes[fn] == mtime and sizes[fn] == sz: continue # no change
                 mtimes[fn] = mtime
                 sizes[fn] = sz
-                tNext = mtime + dt
+                tNext = mtime + self.debouncer.interval(item.path)
                 if tNext not in toSend: toSend[tNext] = []
                 toSend[tNext].append(item.path)
             for tNext in sorted(toSend): # Walk through in time order
@@ -117,6 +178,7 @@ if __name__ == "__main__":
     parser = ArgumentParser()
     Logger.addArgs(parser)
     parser.add_argument("--directory", type=str, required=True, help="Name of directory to monitor")
+    Monitor.addArgs(parser)
     grp = parser.add_mutually_exclusive_group(required=True)
     grp.add_argument("--inotify", action="store_true",
             help="Use INotify to monitor changes in a directory")
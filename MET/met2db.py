@@ -20,6 +20,7 @@ parser = ArgumentParser()
 Logger.addArgs(parser)
 Config.addArgs(parser)
 DB.addArgs(parser)
+Monitor.Monitor.addArgs(parser)
 parser.add_argument("--directory", type=str, required=True, help="Name of directory to monitor")
 grp = parser.add_mutually_exclusive_group(required=True)
 grp.add_argument("--inotify", action="store_true",
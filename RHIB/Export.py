@@ -0,0 +1,339 @@
+#! /usr/bin/env python3
+#
+# Shared pieces of ctd2nc.py and adcp2nc.py
+#
+# Each CTD/ADCP sample is given the mean position of the RHIB's navigation fixes
+# within +-window seconds. Both series are sorted by time, so the window for every
+# sample is found with two searchsorted calls and the means come from cumulative sums,
+# instead of a range join and GROUP BY in the database.
+#
+# The joined rows are appended to the NetCDF files a block at a time.
+#
+# CTD and ADCP hold the tables and file layout of each kind of data,
+# and are used by the one shot ctd2nc.py and adcp2nc.py and the rhib2nc.py daemon.
+#
+from psycopg2.extras import execute_values
+from netCDF4 import Dataset
+from abc import ABC, abstractmethod
+import xarray as xr
+import numpy as np
+import logging
+import datetime
+import time
+import os
+
+def windowMean(tData:np.ndarray, tNav:np.ndarray, values:tuple[np.ndarray],
+        window:float) -> tuple[np.ndarray, list[np.ndarray]]:
+    """ Number of navigation fixes within +-window of each tData, and the mean of each values """
+    i0 = np.searchsorted(tNav, tData - window, side="left")
+    i1 = np.searchsorted(tNav, tData + window, side="right")
+    n = i1 - i0
+    means = []
+    with np.errstate(invalid="ignore", divide="ignore"): # n == 0 rows are dropped by the caller
+        for val in values:
+            cs = np.concatenate(([0], np.cumsum(val, dtype=np.double)))
+            means.append((cs[i1] - cs[i0]) / n)
+    return (n, means)
+
+def navJoin(cur, ship:str, table:str, todo:str, times:str, columns:tuple[str],
+        window:float=10) -> int:
+    """ Add new rows of table to todo with their mean position, returning the number of rows
+
+    Only rows newer than the watermark in times, less 2*window seconds for navigation
+    fixes which arrived after the previous pass, are fetched, so each pass is constant time.
+    """
+    stime = time.time()
+    cur.execute(f"SELECT t FROM {times} WHERE ship=%s;", (ship,))
+    row = cur.fetchone()
+    tLast = row[0] if row else datetime.datetime(1970,1,1,0,0,0,tzinfo=datetime.timezone.utc)
+    tLast -= datetime.timedelta(seconds=2 * window)
+
+    # Uses the (ship, t) primary key
+    cur.execute(f"SELECT t,EXTRACT(EPOCH FROM t) FROM {table} WHERE ship=%s AND t>%s ORDER BY t;",
+            (ship, tLast))
+    rows = cur.fetchall()
+    if not rows:
+        logging.info("No new %s rows for %s", table, ship)
+        return 0
+    tData = np.array([row[1] for row in rows], dtype=np.double)
+
+    sql = "SELECT EXTRACT(EPOCH FROM t),lat,lon FROM rhibNav"
+    sql+= " WHERE ship=%s AND t>=%s AND t<=%s ORDER BY t;"
+    dt = datetime.timedelta(seconds=window)
+    cur.execute(sql, (ship, rows[0][0] - dt, rows[-1][0] + dt))
+    nav = np.array(cur.fetchall(), dtype=np.double).reshape(-1, 3)
+    tFetch = time.time()
+
+    (n, (lat, lon)) = windowMean(tData, nav[:,0], (nav[:,1], nav[:,2]), window)
+    q = n > 0 # Samples without a navigation fix are left for a later pass
+    joined = [(rows[i][0], int(n[i]), float(lat[i]), float(lon[i])) for i in np.flatnonzero(q)]
+    tJoin = time.time()
+
+    if joined:
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS rhibJoin ("
+                + "t TIMESTAMP WITH TIME ZONE PRIMARY KEY, n INTEGER, lat REAL, lon REAL"
+                + ") ON COMMIT DROP;")
+        cur.execute("TRUNCATE rhibJoin;")
+        execute_values(cur, "INSERT INTO rhibJoin VALUES %s;", joined, page_size=10000)
+        sql = f"INSERT INTO {todo}"
+        sql+= " SELECT d.ship,d.box,d.t,j.n,j.lat,j.lon," + ",".join("d." + c for c in columns)
+        sql+= f" FROM {table} AS d INNER JOIN rhibJoin AS j ON d.t=j.t"
+        sql+= " WHERE d.ship=%s"
+        sql+= " ON CONFLICT (ship,t) DO UPDATE SET"
+        sql+= " n=EXCLUDED.n, lat=EXCLUDED.lat, lon=EXCLUDED.lon;"
+        cur.execute(sql, (ship,))
+
+        sql = f"INSERT INTO {times} VALUES (%s,%s)"
+        sql+= " ON CONFLICT (ship) DO UPDATE SET t=GREATEST(EXCLUDED.t, {times}.t);"
+        cur.execute(sql, (ship, joined[-1][0]))
+    tStore = time.time()
+
+    logging.info("Joined %s of %s %s rows to %s fixes for %s,"
+            + " fetch %.2f join %.3f store %.2f seconds",
+            len(joined), len(rows), table, nav.shape[0], ship,
+            tFetch - stime, tJoin - tFetch, tStore - tJoin)
+    return len(joined)
+
+def encoding(variables:dict, coords:dict, unlimited:tuple[str]=("t",), nChunk:int=4096) -> dict:
+    """ xarray to_netcdf encoding compressing and chunking every variable along its unlimited dimension
+
+    Without this an unlimited dimension is chunked one element at a time.
+    """
+    encode = {}
+    for items in (variables, coords):
+        for (name, (dims, val)) in items.items():
+            if isinstance(dims, str): dims = (dims,)
+            if not set(dims).intersection(unlimited): continue
+            chunks = tuple(nChunk if dim in unlimited else size for (dim, size) in zip(dims, val.shape))
+            encode[name] = dict(zlib=True, complevel=4, chunksizes=chunks)
+    return encode
+
+def toNetCDF(cur, ship:str, todo:str, fn:str, columns:tuple[str], encode=None,
+        nFetch:int=10000) -> int:
+    """ Append the rows of todo not yet in fn, returning the number of rows
+
+    Rows are fetched in blocks of nFetch and each block is written with
+    one slice assignment per variable, appended along the variable's first dimension.
+    encode(nc, columns) converts a block's {name: values} to {variable: array},
+    which may differ from columns, i.e. a ragged layout with a row size variable.
+    The default is a plain numpy array per column.
+    """
+    stime = time.time()
+    sql = "SELECT t,box,n,lat,lon," + ",".join(columns) + f" FROM {todo}"
+    sql+= " WHERE ship=%s AND qNetCDF=false"
+    sql+= " ORDER BY t;"
+    cur.execute(sql, (ship,))
+
+    cnt = 0
+    tMax = None
+    with Dataset(fn, mode="a") as nc:
+        v = nc.variables
+        rows = cur.fetchmany(size=nFetch)
+        while rows: # Walk through all the chunks
+            data = list(zip(*rows)) # Row major to column major
+            tMax = data[0][-1]
+            block = dict(
+                    t=np.array([t.timestamp() for t in data[0]]),
+                    box=np.array(data[1]),
+                    n=np.array(data[2]),
+                    lat=np.array(data[3]),
+                    lon=np.array(data[4]),
+                    )
+            raw = dict(zip(columns, data[5:]))
+            if encode:
+                block.update(encode(nc, raw))
+            else:
+                block.update({name: np.array(values) for (name, values) in raw.items()})
+            offsets = {} # Length of each dimension before this block
+            for (name, val) in block.items():
+                dim = v[name].dimensions[0]
+                if dim not in offsets: offsets[dim] = nc.dimensions[dim].size
+                v[name][offsets[dim]:offsets[dim] + len(val)] = val
+            cnt += len(rows)
+            rows = cur.fetchmany(size=nFetch)
+
+    if tMax is not None:
+        sql = f"UPDATE {todo} SET qNetCDF=true"
+        sql+= " WHERE ship=%s"
+        sql+= " AND t<=%s"
+        sql+= " AND qNetCDF=false"
+        sql+= ";"
+        cur.execute("BEGIN;")
+        cur.execute(sql, (ship, tMax))
+        cur.execute("COMMIT;")
+
+    logging.info("Appended %s %s rows for %s to %s in %.2f seconds",
+            cnt, todo, ship, fn, time.time() - stime)
+    return cnt
+
+class Exporter(ABC):
+    """ Join one kind of data for a ship to its navigation, then append it to a NetCDF file """
+    kind = None # Set by subclasses, i.e. CTD
+    columns = () # Data columns copied from rhib{kind} to rhibTodo{kind}
+
+    def __init__(self, ship:str, fn:str) -> None:
+        self.ship = ship
+        self.fn = fn
+        self.table = f"rhib{self.kind}"
+        self.todo = f"rhibTodo{self.kind}"
+        self.times = f"rhibTimes{self.kind}"
+        self.__qTables = False # Have the tables been created by this instance?
+
+    def __repr__(self) -> str:
+        return f"{self.ship} {self.kind} -> {self.fn}"
+
+    @abstractmethod
+    def mkTodoTable(self, cur) -> None:
+        """ Create rhibTodo{kind} """
+
+    @abstractmethod
+    def mkNetCDF(self) -> None:
+        """ Create an empty NetCDF file self.fn """
+
+    def encode(self, nc, columns:dict) -> dict:
+        return {name: np.array(values) for (name, values) in columns.items()}
+
+    def mkTimeTable(self, cur) -> None:
+        sql = f"""
+CREATE TABLE IF NOT EXISTS {self.times} (
+    ship TEXT PRIMARY KEY NOT NULL,
+    t TIMESTAMP WITH TIME ZONE NOT NULL
+    );
+"""
+        cur.execute(sql)
+
+    def mkDirectory(self) -> None:
+        dirname = os.path.dirname(self.fn)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, mode=0o755, exist_ok=True)
+
+    def export(self, cur) -> int:
+        """ Join and append any new rows, returning the number appended """
+        if not os.path.isfile(self.fn): self.mkNetCDF()
+
+        cur.execute("BEGIN;")
+        try:
+            if not self.__qTables:
+                self.mkTimeTable(cur)
+                self.mkTodoTable(cur)
+            navJoin(cur, self.ship, self.table, self.todo, self.times, self.columns)
+            cur.execute("COMMIT;")
+            self.__qTables = True
+        except:
+            cur.execute("ROLLBACK;")
+            logging.exception("Error building joined %s information for %s", self.kind, self.ship)
+
+        return toNetCDF(cur, self.ship, self.todo, self.fn, self.columns, encode=self.encode)
+
+class CTD(Exporter):
+    kind = "CTD"
+    columns = ("temp", "SP")
+
+    def mkTodoTable(self, cur) -> None:
+        sql = """
+CREATE TABLE IF NOT EXISTS rhibTodoCTD (
+    ship TEXT NOT NULL,
+    box INTEGER NOT NULL,
+    t TIMESTAMP WITH TIME ZONE NOT NULL,
+    n INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    temp REAL NOT NULL,
+    SP REAL NOT NULL,
+    qCSV bool DEFAULT false,
+    qNetCDF bool DEFAULT false,
+    PRIMARY KEY(ship,t)
+    );
+"""
+        cur.execute(sql)
+
+    def mkNetCDF(self) -> None:
+        self.mkDirectory()
+
+        variables = dict(
+                box=("t", np.empty(0, dtype=np.uint8)),
+                n=("t", np.empty(0, dtype=np.uint16)),
+                lat=("t", np.empty(0, dtype=np.double)),
+                lon=("t", np.empty(0, dtype=np.double)),
+                temp=("t", np.empty(0, dtype=np.single)),
+                SP=("t", np.empty(0, dtype=np.single)),
+                )
+
+        coords = dict(
+                t=("t", np.empty(0, dtype=np.double)),
+                )
+
+        ds = xr.Dataset(data_vars=variables, coords=coords)
+        ds.t.attrs["units"] = "seconds since 1970-01-01 00:00:00"
+        ds.to_netcdf(self.fn, unlimited_dims="t", encoding=encoding(variables, coords))
+
+class ADCP(Exporter):
+    kind = "ADCP"
+    columns = ("u", "v", "w")
+
+    def mkTodoTable(self, cur) -> None:
+        sql = """
+CREATE TABLE IF NOT EXISTS rhibTodoADCP (
+    ship TEXT NOT NULL,
+    box INTEGER NOT NULL,
+    t TIMESTAMP WITH TIME ZONE NOT NULL,
+    n INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    u REAL[] NOT NULL,
+    v REAL[] NOT NULL,
+    w REAL[] NOT NULL,
+    qCSV bool DEFAULT false,
+    qNetCDF bool DEFAULT false,
+    PRIMARY KEY(ship,t)
+    );
+"""
+        cur.execute(sql)
+
+    def mkNetCDF(self) -> None:
+        # Profiles are stored as a CF contiguous ragged array,
+        # bins of profile k are bin[sum(rowSize[:k]):sum(rowSize[:k+1])]
+        self.mkDirectory()
+
+        variables = dict(
+                box=("t", np.empty(0, dtype=np.uint8)),
+                n=("t", np.empty(0, dtype=np.uint16)),
+                lat=("t", np.empty(0, dtype=np.double)),
+                lon=("t", np.empty(0, dtype=np.double)),
+                rowSize=("t", np.empty(0, dtype=np.uint16)),
+                u=("bin", np.empty(0, dtype=np.single)),
+                v=("bin", np.empty(0, dtype=np.single)),
+                w=("bin", np.empty(0, dtype=np.single)),
+                )
+
+        coords = dict(
+                t=("t", np.empty(0, dtype=np.double)),
+                )
+
+        ds = xr.Dataset(data_vars=variables, coords=coords)
+        ds.attrs["featureType"] = "profile"
+        ds.t.attrs["units"] = "seconds since 1970-01-01 00:00:00"
+        ds.rowSize.attrs["long_name"] = "number of bins in each profile"
+        ds.rowSize.attrs["sample_dimension"] = "bin"
+        unlimited = ("t", "bin")
+        ds.to_netcdf(self.fn, unlimited_dims=unlimited,
+                encoding=encoding(variables, coords, unlimited))
+
+    def encode(self, nc, columns:dict) -> dict:
+        if "i" in nc.dimensions: # Files from before the ragged layout have a fixed width of bins
+            nwide = nc.dimensions["i"].size
+            data = {}
+            for (name, profiles) in columns.items():
+                data[name] = np.ma.masked_all((len(profiles), nwide), dtype=np.single)
+                for (index, profile) in enumerate(profiles):
+                    profile = profile[:nwide]
+                    data[name][index,:len(profile)] = profile
+            return data
+
+        sizes = np.array([len(profile) for profile in columns["u"]], dtype=np.uint16)
+        data = {"rowSize": sizes}
+        for (name, profiles) in columns.items():
+            data[name] = np.concatenate(profiles, dtype=np.single)
+            if data[name].size != sizes.sum(): # The parser only stores profiles with equal sizes
+                raise ValueError(f"{name} profiles are not the same size as u")
+        return data
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+#
+# PostgreSQL table of file positions
+#
+# The table is loaded into memory once, and updates are written through to the cache
+# when their transaction commits. The size and modification time of each file at its
+# last successful pass lets unchanged files be skipped without touching the database.
+#
+import logging
+import os
+
+class FilePosition:
+    def __init__(self, table:str="rhibPos") -> None:
+        self.__create =f"CREATE TABLE IF NOT EXISTS {table} (\n"
+        self.__create+= "  filename TEXT PRIMARY KEY NOT NULL,\n"
+        self.__create+= "  position BIGINT NOT NULL\n"
+        self.__create+=f"); -- {table}"
+        # Status files can grow past 2GB, so widen positions in older tables
+        self.__alter = f"ALTER TABLE {table} ALTER COLUMN position TYPE BIGINT;"
+
+        self.__get = f"SELECT position FROM {table} WHERE filename=%s;"
+
+        self.__set =f"INSERT INTO {table} VALUES (%s,%s)"
+        self.__set+= " ON CONFLICT (filename)"
+        self.__set+= " DO UPDATE SET position = EXCLUDED.position;"
+
+        self.__load = f"SELECT filename,position FROM {table};"
+
+        self.__cache = None # filename -> position, None until loaded
+        self.__stats = {} # filename -> (size, mtime) at the last successful pass
+        self.__pending = {} # filename -> position set in the current transaction
+        self.__pendingStats = {} # filename -> (size, mtime) seen in the current transaction
+
+        logging.info("FilePos\n%s\n%s\n%s", self.__create, self.__get, self.__set)
+
+    def mkTable(self, cur) -> None:
+        cur.execute(self.__create)
+        cur.execute(self.__alter)
+
+    def load(self, cur) -> None:
+        cur.execute(self.__load)
+        self.__cache = {row[0]: row[1] for row in cur}
+        logging.info("Loaded %s file positions", len(self.__cache))
+
+    def changed(self, fn:str) -> bool:
+        """ Has fn changed since its last successful pass? """
+        fn = os.path.abspath(os.path.expanduser(fn))
+        try:
+            st = os.stat(fn)
+        except FileNotFoundError:
+            return False
+        stat = (st.st_size, st.st_mtime_ns)
+        if self.__stats.get(fn) == stat: return False
+        self.__pendingStats[fn] = stat
+        return True
+
+    def committed(self) -> None:
+        """ The transaction holding the set calls was committed, so update the cache """
+        if self.__cache is not None: self.__cache.update(self.__pending)
+        self.__stats.update(self.__pendingStats)
+        self.__pending.clear()
+        self.__pendingStats.clear()
+
+    def rolledBack(self) -> None:
+        self.__pending.clear()
+        self.__pendingStats.clear()
+
+    def get(self, fn:str, cur) -> int:
+        fn = os.path.abspath(os.path.expanduser(fn))
+        if fn in self.__pending: return self.__pending[fn]
+        if self.__cache is not None: return self.__cache.get(fn)
+        cur.execute(self.__get, (fn,))
+        for row in cur:
+            return row[0]
+        return None
+
+    def set(self, fn:str, pos:int, cur) -> bool:
+        try:
+            fn = os.path.abspath(os.path.expanduser(fn))
+            cur.execute(self.__set, (fn, pos))
+            self.__pending[fn] = pos
+            return True
+        except:
+            logging.exception("Trying to set fn=%s pos=%s", fn, pos)
+            return False
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import psycopg2
+
+    parser = ArgumentParser()
+    parser.add_argument("--db", type=str, default="sunrise", help="Database to use")
+    parser.add_argument("--filename", type=str, default="RHIB_status_GS3_UBOX01_Aries_0_0.txt",
+            help="Filename to use")
+    parser.add_argument("--set", type=int, help="Position to set for filename")
+    args = parser.parse_args()
+
+    fp = FilePosition()
+    fn = args.filename
+
+    with psycopg2.connect(f"dbname={args.db}") as db:
+        cur = db.cursor()
+        cur.execute("BEGIN;")
+        fp.mkTable(cur)
+        cur.execute("COMMIT;")
+        fp.load(cur)
+        print("fn", args.filename, "get", fp.get(fn, cur))
+        if args.set is not None:
+            cur.execute("BEGIN;")
+            if fp.set(fn, args.set, cur):
+                cur.execute("COMMIT;")
+                fp.committed()
+            else:
+                cur.execute("ROLLBACK;")
+                fp.rolledBack()
+            print("fn", args.filename, "get", fp.get(fn, cur))
@@ -0,0 +1,414 @@
+#! /usr/bin/env python3
+#
+# Parse RHIB status files into PostgreSQL tables
+#
+from FilePosition import FilePosition
+import logging
+import re
+import datetime
+import numpy as np
+import os
+import io
+import struct
+import time
+
+class RHIB_Parser:
+    def __init__(self) -> None:
+        self.__cursor = None
+        self.__box = None
+        self.__ship = None
+        # Rows accumulated for each table, loaded with COPY then merged
+        self.__rows = {"rhibNav": [], "rhibCTD": [], "rhibADCP": []}
+        self.__timing = {} # Seconds spent in each phase of the current file
+        self.__filepos = FilePosition("rhibPos") # Cached positions in each file
+
+        self.__times = {} # Cache of UTC timestamp to datetime, lines arrive in bursts
+
+        navinfo = b"LAT ([+-]?\d+[.]\d+)"
+        navinfo+= b" LON ([+-]?\d+[.]\d+)"
+        navinfo+= b" HD"
+        self.__navregex = re.compile(navinfo)
+
+        keelctd = b"KDATE (\d{4})-(\d{2})-(\d{2})"
+        keelctd+= b" KTIME (\d{2}):(\d{2}):(\d{2})[.](\d{3})"
+        keelctd+= b" Temp\s+([+-]?\d+[.]\d*)"
+        keelctd+= b" Sal\s+([+-]?\d+[.]\d*)"
+        self.__keelctdregex = re.compile(keelctd)
+
+        self.__shipregex = re.compile(r"_UBOX(\d+)_([a-zA-Z0-9]+)_\d+")
+
+        # Record identifiers, those mapped to None are known but ignored
+        self.__parsers = {
+                b"navinfo": self.__navinfo,
+                b"keelctd": self.__keelctd,
+                b"adcp": self.__adcp,
+                b"winchstatus": None,
+                b"pdbinfo": None,
+                b"param": None,
+                b"wpcount": None,
+                b"curwp": None,
+                b"waypt": None,
+                }
+
+    def cursor(self, cur) -> None:
+        self.__cursor = cur
+
+    def key(self, fn:str) -> tuple[str, str]:
+        """ (box, ship) from a filename, or None if it is not a RHIB status filename """
+        matches = self.__shipregex.search(fn)
+        if not matches:
+            logging.error("Unrecognized filename structure, %s", fn)
+            return None
+        return (matches[1], matches[2])
+
+    def loadPositions(self) -> None:
+        self.__filepos.load(self.__cursor)
+
+    def changed(self, fn:str) -> bool:
+        """ False if fn has the same size and mtime as at its last committed pass """
+        self.__filepos.rolledBack() # Discard anything left from a failed pass
+        return self.__filepos.changed(fn)
+
+    def committed(self) -> None:
+        self.__filepos.committed()
+
+    def rolledBack(self) -> None:
+        self.__filepos.rolledBack()
+
+    def ship(self, fn:str) -> bool:
+        key = self.key(fn)
+        if key is None: return False
+        (self.__box, self.__ship) = key
+        return True
+
+    def notify(self, channel:str) -> None:
+        """ NOTIFY channel with the ship's name, delivered when the transaction commits """
+        self.__cursor.execute("SELECT pg_notify(%s,%s);", (channel, self.__ship))
+
+    def mkTables(self) -> None:
+        self.__filepos.mkTable(self.__cursor)
+        self.__mkNavigationTable()
+        self.__mkCTDTable()
+        self.__mkADCPTable()
+
+    def __mkNavigationTable(self) -> None:
+        sql = "CREATE TABLE IF NOT EXISTS rhibNav (\n"
+        sql+= "  ship TEXT NOT NULL,\n"
+        sql+= "  box INTEGER NOT NULL,\n"
+        sql+= "  t TIMESTAMP WITH TIME ZONE NOT NULL,\n"
+        sql+= "  lat REAL NOT NULL,\n"
+        sql+= "  lon REAL NOT NULL,\n"
+        sql+= "  PRIMARY KEY(ship, t)\n"
+        sql+= ");"
+        self.__cursor.execute(sql)
+
+    def __mkCTDTable(self) -> None:
+        sql = "CREATE TABLE IF NOT EXISTS rhibCTD (\n"
+        sql+= "  ship TEXT NOT NULL,\n"
+        sql+= "  box INTEGER NOT NULL,\n"
+        sql+= "  t TIMESTAMP WITH TIME ZONE NOT NULL,\n"
+        sql+= "  temp REAL NOT NULL,\n"
+        sql+= "  SP REAL NOT NULL,\n"
+        sql+= "  PRIMARY KEY(ship, t)\n"
+        sql+= ");"
+        self.__cursor.execute(sql)
+
+    def __mkADCPTable(self) -> None:
+        sql = "CREATE TABLE IF NOT EXISTS rhibADCP (\n"
+        sql+= "  ship TEXT NOT NULL,\n"
+        sql+= "  box INTEGER NOT NULL,\n"
+        sql+= "  t TIMESTAMP WITH TIME ZONE NOT NULL,\n"
+        sql+= "  u REAL[] NOT NULL,\n"
+        sql+= "  v REAL[] NOT NULL,\n"
+        sql+= "  w REAL[] NOT NULL,\n"
+        sql+= "  PRIMARY KEY(ship, t)\n"
+        sql+= ");"
+        self.__cursor.execute(sql)
+
+    def __time(self, stamp:bytes) -> datetime.datetime:
+        # YYYY/MM/DD HH:MM:SS UTC
+        t = self.__times.get(stamp)
+        if t is not None: return t
+        if len(stamp) != 23 or stamp[19:] != b" UTC": raise ValueError(stamp)
+        t = datetime.datetime(
+                int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+                int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]),
+                tzinfo=datetime.timezone.utc)
+        if len(self.__times) > 10000: self.__times.clear() # Bound the cache
+        self.__times[stamp] = t
+        return t
+
+    def __navinfo(self, box:int, stamp:bytes, tail:bytes, line:bytes) -> int:
+        info = self.__navregex.match(tail)
+        if not info:
+            # logging.info("NAVINFO failure %s", bytes(line))
+            return 0
+        t = self.__time(stamp)
+        lat = float(info[1])
+        lon = float(info[2])
+        self.__rows["rhibNav"].append((self.__ship, box, t, lat, lon))
+        return 1
+
+    def __keelctd(self, box:int, stamp:bytes, tail:bytes, line:bytes) -> int:
+        info = self.__keelctdregex.match(tail)
+        if not info:
+            # logging.info("KEELCTD failure %s", bytes(line))
+            return 0
+        t = datetime.datetime(
+                int(info[1]), int(info[2]), int(info[3]),
+                int(info[4]), int(info[5]), int(info[6]),
+                int(info[7]) * 1000,
+                tzinfo=datetime.timezone.utc)
+        temp = float(info[8])
+        SP = float(info[9])
+        self.__rows["rhibCTD"].append((self.__ship, box, t, temp, SP))
+        return 1
+
+    def __adcp(self, box:int, stamp:bytes, tail:bytes, line:bytes) -> int:
+        # ADATE YYYYMMDD ATIME HHMMSS u u0,u1,... v v0,v1,... w w0,w1,...
+        fields = tail.split(b" ", 10)
+        if len(fields) < 10 or fields[0] != b"ADATE" or fields[2] != b"ATIME" \
+                or fields[4] != b"u" or fields[6] != b"v" or fields[8] != b"w":
+            # logging.info("ADCP failure %s", bytes(line))
+            return 0
+        (date, hms) = (fields[1], fields[3])
+        if len(date) != 8 or len(hms) != 6: return 0
+        t = datetime.datetime(
+                int(date[0:4]), int(date[4:6]), int(date[6:8]),
+                int(hms[0:2]), int(hms[2:4]), int(hms[4:6]),
+                tzinfo=datetime.timezone.utc)
+        # Decode the profiles straight from the bytes, a short result means a bad value
+        n = fields[5].count(b",") + 1
+        u = np.fromstring(fields[5], dtype=np.float32, sep=",")
+        v = np.fromstring(fields[7], dtype=np.float32, sep=",")
+        w = np.fromstring(fields[9], dtype=np.float32, sep=",")
+        if u.size != n or v.size != n or w.size != n:
+            return 0
+        self.__rows["rhibADCP"].append((self.__ship, box, t, u, v, w))
+        return 1
+
+    def clear(self) -> None:
+        for rows in self.__rows.values(): rows.clear()
+
+    @staticmethod
+    def __copyBinary(rows:list[tuple]) -> io.BytesIO:
+        # PostgreSQL binary COPY of (ship, box, t, u, v, w) with float32 arrays,
+        # so the profiles are never converted to Python floats or text
+        epoch = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc) # PostgreSQL's epoch
+        element = np.dtype([("len", ">i4"), ("val", ">f4")])
+        buffer = io.BytesIO()
+        buffer.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+        for (ship, box, t, u, v, w) in rows:
+            ship = bytes(ship, "UTF-8")
+            dt = t - epoch
+            usec = (dt.days * 86400 + dt.seconds) * 1000000 + dt.microseconds
+            buffer.write(struct.pack(">hi", 6, len(ship)) + ship)
+            buffer.write(struct.pack(">iiiq", 4, box, 8, usec))
+            for profile in (u, v, w):
+                items = np.empty(profile.size, dtype=element)
+                items["len"] = 4
+                items["val"] = profile
+                # ndim, has nulls, float4 OID, dimension size, lower bound
+                header = struct.pack(">iiiii", 1, 0, 700, profile.size, 1)
+                buffer.write(struct.pack(">i", len(header) + items.nbytes) + header)
+                buffer.write(items.tobytes())
+        buffer.write(struct.pack(">h", -1))
+        buffer.seek(0)
+        return buffer
+
+    @staticmethod
+    def __copyValue(val) -> str:
+        # COPY text format, the ship names and numbers never need escaping
+        if isinstance(val, datetime.datetime): return val.isoformat()
+        return str(val)
+
+    def __flush(self) -> int:
+        """ COPY the accumulated rows into staging tables, then merge them into the real tables """
+        cur = self.__cursor
+        timing = self.__timing
+        cnt = 0
+        for (tbl, rows) in self.__rows.items():
+            if not rows: continue
+            stime = time.time()
+            stage = tbl + "_stage"
+            # Dropped at the end of the file's transaction
+            cur.execute(f"CREATE TEMPORARY TABLE IF NOT EXISTS {stage}"
+                    + f" (LIKE {tbl} INCLUDING DEFAULTS) ON COMMIT DROP;")
+            if tbl == "rhibADCP":
+                cur.copy_expert(f"COPY {stage} FROM STDIN WITH (FORMAT binary);",
+                        self.__copyBinary(rows))
+            else:
+                value = self.__copyValue
+                buffer = io.StringIO()
+                for row in rows: buffer.write("\t".join(map(value, row)) + "\n")
+                buffer.seek(0)
+                cur.copy_expert(f"COPY {stage} FROM STDIN;", buffer)
+            t0 = time.time()
+            cur.execute(f"INSERT INTO {tbl} SELECT * FROM {stage} ON CONFLICT DO NOTHING;")
+            cnt += cur.rowcount
+            cur.execute(f"TRUNCATE {stage};")
+            t1 = time.time()
+            timing["copy"] = timing.get("copy", 0) + t0 - stime
+            timing["merge"] = timing.get("merge", 0) + t1 - t0
+            rows.clear()
+        return cnt
+
+    def parseLines(self, buffer:bytes) -> tuple[bytes, int]:
+        # DD-Mon-YYYY HH:MM:SS UBOXnn -- ident -- YYYY/MM/DD HH:MM:SS UTC -- tail
+        # Split on the separators and dispatch on ident before any other work
+        parsers = self.__parsers
+        lines = bytes(buffer).split(b"\n") # bytes(bytes) is the same object, not a copy
+        remainder = lines.pop() # The partial line after the last \n, b"" if there is none
+        cnt = 0
+        for line in lines:
+            fields = line.split(b" -- ", 3)
+            if len(fields) != 4:
+                if line: logging.debug("Unrecognized line %s", line)
+                continue
+            (head, ident, stamp, tail) = fields
+            parser = parsers.get(ident, False)
+            if not parser:
+                if parser is False: logging.debug("Unrecognized id %s line %s", ident, line)
+                continue # Ignored record type
+            if head[-6:-2] != b"UBOX" or not head[-2:].isdigit():
+                logging.debug("Unrecognized line %s", line)
+                continue
+            try:
+                cnt += parser(int(head[-2:]), stamp, tail.rstrip(b"\r"), line)
+            except ValueError:
+                logging.debug("Bad values in line %s", line)
+
+        return (remainder, cnt)
+
+    def parseFile(self, fn:str) -> int:
+        fn = os.path.abspath(os.path.expanduser(fn))
+        cur = self.__cursor
+        spos = self.__filepos.get(fn, cur) or 0
+        fsize = os.path.getsize(fn)
+        if spos == fsize:
+            logging.info("Skipping %s, fully processed", fn)
+            return 0
+        
+        if spos > fsize: # File was truncated, so reprocess
+            logging.info("Truncated %s", fn)
+            spos = 0
+
+        stime = time.time()
+        self.__timing = {"copy": 0, "merge": 0}
+        self.clear() # Left from a failed file
+        chunk = 16 * 1024 * 1024
+        cnt = 0
+        nInserted = 0
+        # Only read up to the size seen now, anything appended is picked up on the next notification.
+        # The stored position is the exact offset just after the last complete line parsed,
+        # so reading resumes there. Each window is read into one bytes object, which parseLines
+        # splits into a copy per line. The partial line at its end is reread as the start of the
+        # next window.
+        with open(fn, "rb") as fp:
+            pos = spos
+            size = chunk
+            while pos < fsize:
+                fp.seek(pos)
+                data = fp.read(min(size, fsize - pos))
+                if not data: break # Truncated while reading
+                if b"\n" not in data:
+                    if pos + len(data) >= fsize: break # Only a partial line remains
+                    size *= 2 # A line longer than the window
+                    continue
+                size = chunk
+                (remainder, n) = self.parseLines(data)
+                cnt += n
+                nInserted += self.__flush() # One COPY and merge per table per window
+                pos += len(data) - len(remainder)
+        if not self.__filepos.set(fn, pos, cur): raise Exception(f"Unable to set position for {fn}")
+        dt = time.time() - stime
+        timing = self.__timing
+        logging.info("Inserted %s of %s records from %s in %.2f seconds, parse %.2f copy %.2f merge %.2f",
+                nInserted, cnt, fn, dt, dt - timing["copy"] - timing["merge"],
+                timing["copy"], timing["merge"])
+        return nInserted
+
+if __name__ == "__main__":
+    # Benchmark the prefix dispatch parser against the original regex per line parser
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("fn", type=str, help="Recorded RHIB status file")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of passes through the file")
+    args = parser.parse_args()
+
+    with open(args.fn, "rb") as fp: content = fp.read()
+
+    prefix = b"^\d{2}-\w+-\d{4} \d{2}:\d{2}:\d{2} UBOX(\d{2}) -- (\w+) -- "
+    prefix+= b"(\d{4})/(\d{2})/(\d{2}) (\d{2}):(\d{2}):(\d{2}) UTC -- (.+)"
+    rePrefix = re.compile(prefix)
+    reNav = re.compile(b"LAT ([+-]?\d+[.]\d+) LON ([+-]?\d+[.]\d+) HD")
+    reKeel = re.compile(b"KDATE (\d{4})-(\d{2})-(\d{2}) KTIME (\d{2}):(\d{2}):(\d{2})[.](\d{3})"
+            + b" Temp\s+([+-]?\d+[.]\d*) Sal\s+([+-]?\d+[.]\d*)")
+    reADCP = re.compile(b"ADATE (\d{4})(\d{2})(\d{2}) ATIME (\d{2})(\d{2})(\d{2})"
+            + b" u ([+-]?\d+[.]\d+(?:,[+-]?\d+[.]\d+)*)"
+            + b" v ([+-]?\d+[.]\d+(?:,[+-]?\d+[.]\d+)*)"
+            + b" w ([+-]?\d+[.]\d+(?:,[+-]?\d+[.]\d+)*)")
+    utc = datetime.timezone.utc
+    ignore = ("winchstatus", "pdbinfo", "param", "wpcount", "curwp", "waypt")
+
+    def original(buffer:bytes) -> int:
+        cnt = 0
+        offset = 0
+        while True:
+            index = buffer.find(b"\n", offset)
+            if index < 0: break
+            line = buffer[offset:index]
+            offset = index + 1
+            fields = rePrefix.match(line)
+            if not fields: continue
+            box = int(fields[1])
+            ident = str(fields[2], "UTF-8")
+            t = datetime.datetime(int(fields[3]), int(fields[4]), int(fields[5]),
+                    int(fields[6]), int(fields[7]), int(fields[8]), tzinfo=utc)
+            tail = fields[9]
+            if ident == "navinfo":
+                info = reNav.match(tail)
+                if info: (lat, lon) = (float(info[1]), float(info[2]))
+            elif ident == "keelctd":
+                info = reKeel.match(tail)
+                if info:
+                    t = datetime.datetime(int(info[1]), int(info[2]), int(info[3]),
+                            int(info[4]), int(info[5]), int(info[6]), int(info[7]) * 1000, tzinfo=utc)
+                    (temp, SP) = (float(info[8]), float(info[9]))
+            elif ident == "adcp":
+                info = reADCP.match(tail)
+                if info:
+                    t = datetime.datetime(int(info[1]), int(info[2]), int(info[3]),
+                            int(info[4]), int(info[5]), int(info[6]), tzinfo=utc)
+                    u = np.array(str(info[7], "UTF-8").split(",")).astype(float).tolist()
+                    v = np.array(str(info[8], "UTF-8").split(",")).astype(float).tolist()
+                    w = np.array(str(info[9], "UTF-8").split(",")).astype(float).tolist()
+            elif ident not in ignore:
+                continue
+            else:
+                continue
+            cnt += info is not None
+        return cnt
+
+    rhib = RHIB_Parser()
+    rhib.ship("_UBOX01_benchmark_0")
+    nOrig = original(content)
+    (remainder, nFast) = rhib.parseLines(content)
+    if nOrig != nFast: print(f"WARNING: original {nOrig} and fast {nFast} record counts differ")
+
+    nLines = content.count(b"\n") * args.repeat
+    stime = time.time()
+    for cnt in range(args.repeat): original(content)
+    dtOrig = time.time() - stime
+
+    stime = time.time()
+    for cnt in range(args.repeat):
+        rhib.clear()
+        rhib.parseLines(content)
+    dtFast = time.time() - stime
+
+    print(f"{nLines} lines {nFast} records per pass")
+    print(f"Original {dtOrig:.3f} seconds {nLines/dtOrig:.0f} lines/second")
+    print(f"Fast     {dtFast:.3f} seconds {nLines/dtFast:.0f} lines/second")
+    print(f"Speedup  {dtOrig/dtFast:.2f}")
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+#
+# Long running export of RHIB CTD and ADCP data to NetCDF files
+#
+# rhib2db NOTIFYs a channel with the ship's name each time it commits new rows.
+# The notified ships are exported at most once every --dt seconds, coalescing notifications.
+# Every ship is also exported at startup and after --maxWait seconds without an export,
+# in case a notification was missed.
+#
+
+from argparse import ArgumentParser
+from TPWUtils import Logger
+from TPWUtils.Thread import Thread
+import Export
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import logging
+import select
+import time
+
+class RHIB2NC(Thread):
+    def __init__(self, args:ArgumentParser) -> None:
+        Thread.__init__(self, "RHIB2NC", args)
+        self.exporters = {}
+        for ship in args.ship:
+            self.exporters[ship] = (
+                    Export.CTD(ship, args.ctd.format(ship=ship)),
+                    Export.ADCP(ship, args.adcp.format(ship=ship)),
+                    )
+
+    @staticmethod
+    def addArgs(parser:ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Export options")
+        grp.add_argument("--ship", type=str, action="append", required=True,
+                help="RHIB to export, may be repeated")
+        grp.add_argument("--ctd", type=str, required=True,
+                help="CTD NetCDF filename, {ship} is replaced by the ship's name")
+        grp.add_argument("--adcp", type=str, required=True,
+                help="ADCP NetCDF filename, {ship} is replaced by the ship's name")
+        grp.add_argument("--channel", type=str, default="rhib",
+                help="Channel rhib2db NOTIFYs when it commits new rows")
+        grp.add_argument("--dt", type=float, default=60,
+                help="Minimum seconds between exports, notifications in between are coalesced")
+        grp.add_argument("--maxWait", type=float, default=600,
+                help="Export every ship if nothing has been exported for this many seconds")
+
+    def export(self, cur, ships:set) -> None:
+        for ship in sorted(ships):
+            for exporter in self.exporters[ship]:
+                stime = time.time()
+                try:
+                    n = exporter.export(cur)
+                    logging.info("Exported %s rows %s in %.2f seconds", n, exporter, time.time() - stime)
+                except:
+                    logging.exception("Exporting %s", exporter)
+                    if cur.connection.closed: raise # Lost the database, so let systemd restart us
+
+    def collect(self, db, pending:set) -> None:
+        while db.notifies:
+            notice = db.notifies.pop(0)
+            if notice.payload in self.exporters:
+                pending.add(notice.payload)
+            else:
+                logging.debug("Ignoring notification for %s", notice.payload)
+
+    def runIt(self) -> None: # Called on thread start
+        args = self.args
+        logging.info("Starting %s", ",".join(self.exporters))
+        with psycopg2.connect(f"dbname={args.db}") as db:
+            # Notifications are only delivered outside of transactions,
+            # so the exporters manage their own with BEGIN/COMMIT
+            db.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            cur = db.cursor()
+            cur.execute(f"LISTEN \"{args.channel}\";") # Quoted to match pg_notify's exact name
+
+            pending = set(self.exporters) # Export everything at startup
+            tExport = 0 # Earliest time for the next export
+            tLast = time.time() # Time of the last export
+            while True:
+                # Every execute, including the exporters', moves notifications which have arrived
+                # into db.notifies, so always drain it rather than relying on select
+                self.collect(db, pending)
+                now = time.time()
+                if pending and now >= tExport:
+                    ships = pending
+                    pending = set() # Notifications during the export are for the next one
+                    self.export(cur, ships)
+                    tLast = time.time()
+                    tExport = tLast + args.dt
+                    continue
+                if not pending and now >= (tLast + args.maxWait):
+                    logging.info("Nothing exported for %s seconds", args.maxWait)
+                    pending = set(self.exporters)
+                    continue
+
+                dt = (tExport if pending else (tLast + args.maxWait)) - now
+                (rlist, wlist, xlist) = select.select([db], [], [], max(0, dt))
+                if rlist: db.poll() # Read notifications into db.notifies
+
+parser = ArgumentParser()
+Logger.addArgs(parser)
+RHIB2NC.addArgs(parser)
+parser.add_argument("--db", type=str, default="sunrise", help="Database name to connect to")
+args = parser.parse_args()
+
+Logger.mkLogger(args)
+
+logging.info("Args %s", args)
+
+try:
+    exporter = RHIB2NC(args)
+    exporter.start()
+
+    Thread.waitForException()
+except:
+    logging.exception("Unexpected exception")